@@ -0,0 +1,560 @@
+"""Benchmarks for tally-investment-records.py, run against synthetic data so no pdfs are needed.
+
+Usage:
+    python benchmark.py [lot-matching] [parsing] [pipeline] [startup] [backends] [ledgers] [holdings] [--trades N] [--codes N]
+        [--legacy-trades N] [--iterations N] [--scales N [N ...]] [--output FILE] [--baseline FILE]
+        [--tolerance FRACTION] [--backend-files N] [--ledger-trades N] [--ledger-codes N] [--jobs N]
+        [--queries N]
+
+The pipeline benchmark times each stage of a run on its own, at each scale, and can write its results as JSON.
+Given the results of an earlier run as a baseline, it reports each stage's change and exits with status 1 if any
+stage is slower than the baseline by more than the tolerance.
+
+"""
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+from datetime import datetime, timedelta
+
+SCRIPT_FILENAME = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tally-investment-records.py")
+SAMPLE_DATA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sample_data")
+
+def load_tally_module():
+    """Import tally-investment-records.py, which can't be imported by name because of the dashes.
+
+    """
+    spec = importlib.util.spec_from_file_location("tally_investment_records", SCRIPT_FILENAME)
+    module = importlib.util.module_from_spec(spec)
+    # Registered so that worker processes can find the module's functions by name
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+def make_synthetic_trades(tally, code: str, num_trades: int, seed: int = 0) -> list:
+    """Return num_trades buy and sell records for one code, in date order.
+
+    Sales never exceed the quantity held, so every sale can be matched. Trades on the same day are put in
+    trade type order on a sheet, which puts buys first and so keeps every sale covered.
+
+    """
+    rng = random.Random(seed)
+    records = []
+    held = 0
+    trade_date = datetime(2000, 7, 1)
+    for idx in range(num_trades):
+        trade_date += timedelta(days=rng.randint(0, 2))
+        if held > 0 and rng.random() < 0.4:
+            trade_type = "Sell"
+            quantity = float(rng.randint(1, int(held)))
+            held -= quantity
+        else:
+            trade_type = "Buy"
+            quantity = float(rng.randint(1, 500))
+            held += quantity
+        records.append(tally.InvestmentRecord.from_fields(
+            "WH_ContractNote_" + code + "_" + str(idx) + ".pdf", tally.WH_CONTRACTNOTE, {
+                "trade_type": trade_type,
+                "trade_date": trade_date,
+                "quantity": quantity,
+                "code": code,
+                "average_price_per_share": round(rng.uniform(5, 150), 4),
+                "brokerage": 19.95
+            }))
+    return records
+
+def match_with_lot_matcher(tally, table, rows, policy: str) -> list:
+    lot_matcher = tally.LotMatcher(table, policy)
+    return [lot_matcher.add_record(row) for row in rows]
+
+def match_with_find_records_to_sell_fifo(tally, records: list) -> list:
+    for record in records:
+        record.available_quantity = record.quantity
+    matches = []
+    for record in records:
+        if record.trade_type.lower() in tally.SALE_TRADE_TYPES:
+            matches.append(tally.find_records_to_sell_fifo(records, record))
+        else:
+            matches.append([])
+    return matches
+
+def report(name: str, num_trades: int, seconds: float) -> None:
+    print("{:<40} {:>9,} trades {:>9.3f}s {:>12,.0f} trades/s".format(
+        name, num_trades, seconds, num_trades / seconds if seconds else float("inf")))
+
+def benchmark_lot_matching(tally, num_trades: int, num_codes: int, legacy_trades: int) -> None:
+    """Time each LotMatcher policy over num_trades trades per code, and compare with find_records_to_sell_fifo.
+
+    find_records_to_sell_fifo rescans from the start for every sale, so it is only run over the first
+    legacy_trades trades of each code. Its matches are checked against the fifo policy over the same trades.
+
+    """
+    records = []
+    for idx in range(num_codes):
+        records += make_synthetic_trades(tally, "SYN" + str(idx), num_trades, seed=idx)
+    total_trades = num_trades * num_codes
+
+    start = time.perf_counter()
+    table = tally.RecordTable.from_records(records)
+    report("RecordTable.from_records", total_trades, time.perf_counter() - start)
+
+    for policy in tally.LotMatcher.POLICIES:
+        start = time.perf_counter()
+        for rows in table.by_code.values():
+            match_with_lot_matcher(tally, table, rows, policy)
+        report("LotMatcher " + policy, total_trades, time.perf_counter() - start)
+
+    if legacy_trades <= 0:
+        return
+    # Table rows are numbered in the order the records were added
+    legacy_rows_by_code = [rows[:legacy_trades] for rows in table.by_code.values()]
+    legacy_by_code = [[records[row] for row in rows] for rows in legacy_rows_by_code]
+    legacy_total = sum(len(rows) for rows in legacy_rows_by_code)
+    start = time.perf_counter()
+    legacy_matches = [match_with_find_records_to_sell_fifo(tally, code_records) for code_records in legacy_by_code]
+    report("find_records_to_sell_fifo", legacy_total, time.perf_counter() - start)
+
+    for rows, expected in zip(legacy_rows_by_code, legacy_matches):
+        matches = match_with_lot_matcher(tally, table, rows, "fifo")
+        if [[(id(records[row]), quant) for row, quant in match] for match in matches] \
+                != [[(id(rec), quant) for rec, quant in match] for match in expected]:
+            raise Exception("LotMatcher fifo doesn't match find_records_to_sell_fifo")
+    print("LotMatcher fifo matches find_records_to_sell_fifo over " + format(legacy_total, ",") + " trades")
+
+def load_sample_texts(tally) -> list:
+    """Return a list of (sample filename, record_type, text) for the sample_data texts.
+
+    The record type is recognised from the sample filename, e.g. Sample_WH_ContractNote_text.txt.
+
+    """
+    samples = []
+    for filename in sorted(os.listdir(SAMPLE_DATA_PATH)):
+        for record_type, parser in tally.RECORD_PARSERS.items():
+            if filename.startswith("Sample_" + parser.name + "_"):
+                with open(os.path.join(SAMPLE_DATA_PATH, filename), encoding="utf-8", errors="replace") as f:
+                    samples.append((filename, record_type, f.read()))
+                break
+    return samples
+
+def benchmark_parsing(tally, iterations: int) -> None:
+    """Time RecordParser.parse over each sample_data text, reporting records per second.
+
+    """
+    for filename, record_type, text in load_sample_texts(tally):
+        parser = tally.RECORD_PARSERS[record_type]
+        start = time.perf_counter()
+        for _ in range(iterations):
+            parser.parse(text, filename)
+        seconds = time.perf_counter() - start
+        print("{:<52} {:>9,} records {:>9.3f}s {:>12,.0f} records/s".format(
+            "parse " + filename, iterations, seconds, iterations / seconds if seconds else float("inf")))
+
+class TextTemplate():
+    """A sample_data text with the fields found by its record type's parser replaced by new values.
+
+    The spans of the fields are found once, by matching the parser's patterns as RecordParser.parse does.
+    Fields without a value given to render are left as they are in the sample.
+
+    """
+
+    def __init__(self, parser, text: str) -> None:
+        self.text = text
+        self.spans = []
+        pos = 0
+        for pattern in parser.patterns:
+            match = pattern.search(text, pos)
+            if match:
+                pos = match.end()
+            else:
+                match = pattern.search(text)
+                if not match:
+                    continue
+            for name in match.groupdict():
+                if match.group(name) is not None:
+                    self.spans.append((match.start(name), match.end(name), name))
+        self.spans.sort()
+
+    def render(self, values: dict) -> str:
+        parts = []
+        pos = 0
+        for start, end, name in self.spans:
+            if name in values:
+                parts.append(self.text[pos:start])
+                parts.append(values[name])
+                pos = end
+        parts.append(self.text[pos:])
+        return "".join(parts)
+
+# How the fields of each sample_data text are written, by parser name
+TEXT_DATE_FORMATS = {
+    "WH_ContractNote": "%d/%m/%Y",
+    "FAIR_Distribution_Advice": "%d %B %Y",
+    "VDGR_Reinvestment_Plan_Advice": "%d %B %Y"
+}
+
+def load_text_templates(tally) -> dict:
+    """Return a dict of record type: TextTemplate, made from the first sample_data text of each type.
+
+    """
+    templates = {}
+    for filename, record_type, text in load_sample_texts(tally):
+        if record_type not in templates:
+            templates[record_type] = TextTemplate(tally.RECORD_PARSERS[record_type], text)
+    return templates
+
+def make_synthetic_texts(tally, num_records: int, num_codes: int, seed: int = 0) -> list:
+    """Return num_records (filename, record_type, text) in date order, as they would be read from pdfs.
+
+    Most are contract notes buying and selling num_codes codes, with FAIR distribution and VDGR reinvestment
+    plan advices mixed in. Sales never exceed the quantity held, so every sale can be matched.
+
+    """
+    rng = random.Random(seed)
+    templates = load_text_templates(tally)
+    codes = ["SYN" + str(idx) for idx in range(num_codes)]
+    held = {code: 0 for code in codes}
+    texts = []
+    trade_date = datetime(2000, 7, 1)
+    for idx in range(num_records):
+        trade_date += timedelta(days=rng.randint(0, 1))
+        roll = rng.random()
+        if roll < 0.05:
+            record_type = tally.FAIR_DISTRIBUTION_ADVICE
+            values = {"code": "FAIR", "quantity": str(rng.randint(1, 60)),
+                "average_price_per_share": "${:.6f}".format(rng.uniform(15, 25))}
+        elif roll < 0.1:
+            record_type = tally.VDGR_REINVESTMENT_PLAN_ADVICE
+            values = {"quantity": str(rng.randint(1, 20)), "average_price_per_share": "${:.4f}".format(rng.uniform(45, 65))}
+        else:
+            record_type = tally.WH_CONTRACTNOTE
+            code = rng.choice(codes)
+            if held[code] > 0 and rng.random() < 0.4:
+                trade_type, quantity = "Sell", rng.randint(1, held[code])
+                held[code] -= quantity
+            else:
+                trade_type, quantity = "Buy", rng.randint(1, 500)
+                held[code] += quantity
+            values = {"trade_type": trade_type, "code": code + ".ASX", "quantity": str(quantity),
+                "average_price_per_share": "${:.4f}".format(rng.uniform(5, 150)), "brokerage": "$19.95"}
+        parser = tally.RECORD_PARSERS[record_type]
+        date_text = trade_date.strftime(TEXT_DATE_FORMATS[parser.name])
+        values.update({"trade_date": date_text, "as_at_date": date_text})
+        filename = parser.name + "_" + str(idx) + ".pdf"
+        texts.append((filename, record_type, templates[record_type].render(values)))
+    return texts
+
+def make_synthetic_tree(path: str, texts: list, files_per_directory: int = 500) -> None:
+    """Create an empty file for each synthetic text, spread over subdirectories as records are usually filed.
+
+    """
+    for idx, (filename, record_type, text) in enumerate(texts):
+        dirpath = os.path.join(path, str(idx // files_per_directory))
+        if idx % files_per_directory == 0:
+            os.makedirs(dirpath)
+        open(os.path.join(dirpath, filename), "w").close()
+
+def time_stage(results: dict, name: str, function, *args):
+    """Call function, keeping its shortest duration so far in results[name], and return its result.
+
+    """
+    start = time.perf_counter()
+    result = function(*args)
+    seconds = time.perf_counter() - start
+    results[name] = min(seconds, results.get(name, seconds))
+    return result
+
+def benchmark_pipeline(tally, scales: list, num_codes: int, legacy_trades: int, repeat: int = 3) -> dict:
+    """Time each stage of a run over synthetic records at each scale, returning {scale: {stage: seconds}}.
+
+    Stages are timed on their own, each given the output of the one before:
+        scan: get_investment_record_filenames over a tree of empty files named like the records
+        parse: InvestmentRecord.from_text for every synthetic text
+        lot-matching: LotMatcher over every code, as construct_investment_record_workbook does
+        find-records-to-sell-fifo: find_records_to_sell_fifo, which is quadratic, over the first
+            legacy_trades records of each code
+        construct: construct_investment_record_workbook
+        save: save_workbook
+
+    The whole run is repeated and the shortest time of each stage is kept.
+
+    """
+    all_results = {}
+    for scale in scales:
+        texts = make_synthetic_texts(tally, scale, num_codes, seed=scale)
+        results = {}
+        path = tempfile.mkdtemp(prefix="tally-benchmark-")
+        try:
+            make_synthetic_tree(path, texts)
+            for _ in range(repeat):
+                filenames = time_stage(results, "scan", tally.get_investment_record_filenames, path)
+                if len(filenames) != scale:
+                    raise Exception("Scan found " + str(len(filenames)) + " of " + str(scale) + " files")
+
+                records = time_stage(results, "parse", lambda: [
+                    tally.InvestmentRecord.from_text(filename, record_type, text) for filename, record_type, text in texts])
+
+                tally.normalise_codes(records)
+                table = tally.RecordTable.from_records(records)
+                time_stage(results, "lot-matching", lambda: [
+                    match_with_lot_matcher(tally, table, rows, "fifo") for rows in table.by_code.values()])
+                if legacy_trades > 0:
+                    legacy_by_code = [[records[row] for row in rows[:legacy_trades]] for rows in table.by_code.values()]
+                    time_stage(results, "find-records-to-sell-fifo", lambda: [
+                        match_with_find_records_to_sell_fifo(tally, code_records) for code_records in legacy_by_code])
+
+                # A write-only workbook can only be saved once, so it is built again each time
+                workbook = time_stage(results, "construct", tally.construct_investment_record_workbook, records)
+                output_filename = os.path.join(path, "Investment_Record_Tally.xlsx")
+                if os.path.isfile(output_filename):
+                    os.remove(output_filename)
+                time_stage(results, "save", tally.save_workbook, workbook, output_filename)
+        finally:
+            shutil.rmtree(path)
+
+        for stage, seconds in results.items():
+            print("{:<40} {:>9,} records {:>9.3f}s {:>12,.0f} records/s".format(
+                "pipeline " + stage, scale, seconds, scale / seconds if seconds else float("inf")))
+        all_results[str(scale)] = results
+    return all_results
+
+# Slowdowns smaller than this are timer noise, however large a fraction of the baseline they are
+NOISE_SECONDS = 0.01
+
+def compare_with_baseline(results: dict, baseline: dict, tolerance: float) -> list:
+    """Print each stage's change from a baseline, and return the (scale, stage) of stages slower than the tolerance.
+
+    Stages or scales missing from either run are skipped.
+
+    """
+    regressions = []
+    for scale, stages in results.items():
+        for stage, seconds in stages.items():
+            baseline_seconds = baseline.get(scale, {}).get(stage)
+            if not baseline_seconds:
+                continue
+            change = seconds / baseline_seconds - 1
+            regressed = change > tolerance and seconds - baseline_seconds > NOISE_SECONDS
+            print("{:<40} {:>9} records {:>+8.1%}{}".format(
+                "pipeline " + stage, scale, change, "  REGRESSION" if regressed else ""))
+            if regressed:
+                regressions.append((scale, stage))
+    return regressions
+
+def benchmark_startup(repeat: int = 5) -> None:
+    """Time running the script with --help, against starting the interpreter alone.
+
+    """
+    for name, command in [
+        ("python startup", [sys.executable, "-c", "pass"]),
+        ("tally-investment-records.py --help", [sys.executable, SCRIPT_FILENAME, "--help"])
+    ]:
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+            times.append(time.perf_counter() - start)
+        print("{:<40} {:>9.3f}s best of {}".format(name, min(times), repeat))
+
+def _pdf_string(text: str) -> str:
+    text = text.encode("latin-1", errors="replace").decode("latin-1")
+    return "(" + text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)") + ")"
+
+def write_text_pdf(filename: str, page_texts: list) -> None:
+    """Write a minimal pdf whose text layer holds each line of each page text, as PyPDF2 extracts them.
+
+    """
+    num_pages = len(page_texts)
+    # Objects are the catalog, the page tree, the font, then a page and its content for each page
+    objects = [
+        "<< /Type /Catalog /Pages 2 0 R >>",
+        "<< /Type /Pages /Kids [" + " ".join(str(4 + 2 * idx) + " 0 R" for idx in range(num_pages))
+            + "] /Count " + str(num_pages) + " >>",
+        "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"
+    ]
+    for idx, text in enumerate(page_texts):
+        content = "BT /F1 8 Tf 10 TL 20 820 Td\n" + "".join(
+            _pdf_string(line) + " Tj T*\n" for line in text.split("\n")) + "ET"
+        objects.append("<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Resources << /Font << /F1 3 0 R >> >> "
+            "/Contents " + str(5 + 2 * idx) + " 0 R >>")
+        objects.append("<< /Length " + str(len(content.encode("latin-1"))) + " >>\nstream\n" + content + "\nendstream")
+
+    data = b"%PDF-1.4\n"
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(data))
+        data += (str(number) + " 0 obj\n" + body + "\nendobj\n").encode("latin-1")
+    xref_offset = len(data)
+    data += ("xref\n0 " + str(len(objects) + 1) + "\n0000000000 65535 f \n"
+        + "".join("{:010d} 00000 n \n".format(offset) for offset in offsets)
+        + "trailer\n<< /Size " + str(len(objects) + 1) + " /Root 1 0 R >>\nstartxref\n"
+        + str(xref_offset) + "\n%%EOF\n").encode("latin-1")
+    with open(filename, "wb") as f:
+        f.write(data)
+
+def benchmark_backends(tally, num_files: int) -> None:
+    """Time each extraction backend over the same synthetic files, reporting files per second.
+
+    Each synthetic text is written as a pdf, and as the .txt file read by the pre-extracted text backend.
+    The text from every backend is parsed, to check the backend gives text the parsers can read.
+
+    """
+    texts = make_synthetic_texts(tally, num_files, 20)
+    path = tempfile.mkdtemp(prefix="tally-benchmark-")
+    try:
+        files = []
+        for filename, record_type, text in texts:
+            filename = os.path.join(path, filename)
+            write_text_pdf(filename, [text])
+            with open(filename + ".txt", "w", encoding="utf-8") as f:
+                f.write(text)
+            files.append((filename, record_type))
+
+        for name, backend in tally.EXTRACTION_BACKENDS.items():
+            start = time.perf_counter()
+            extracted = [backend.extract_single_page(filename) for filename, record_type in files]
+            seconds = time.perf_counter() - start
+            for (filename, record_type), text in zip(files, extracted):
+                tally.RECORD_PARSERS[record_type].parse(text, filename)
+            print("{:<40} {:>9,} files {:>9.3f}s {:>12,.0f} files/s".format(
+                "extract " + name, num_files, seconds, num_files / seconds if seconds else float("inf")))
+    finally:
+        shutil.rmtree(path)
+
+def benchmark_ledgers(tally, num_trades: int, num_codes: int, jobs: int) -> None:
+    """Time computing the code ledgers, and constructing the workbook, in this process and with jobs workers.
+
+    The workbooks are saved and compared, to check the workers give the same sheets.
+
+    """
+    records = []
+    for idx in range(num_codes):
+        records += make_synthetic_trades(tally, "SYN" + str(idx), num_trades, seed=idx)
+    total_trades = num_trades * num_codes
+    table = tally.RecordTable.from_records(records)
+
+    saved = {}
+    for num_jobs in (1, jobs):
+        start = time.perf_counter()
+        for ledger in tally.compute_code_ledgers(table, list(table.by_code), jobs=num_jobs):
+            pass
+        report("compute_code_ledgers jobs=" + str(num_jobs), total_trades, time.perf_counter() - start)
+
+        start = time.perf_counter()
+        workbook = tally.construct_investment_record_workbook(records, jobs=num_jobs)
+        report("construct jobs=" + str(num_jobs), total_trades, time.perf_counter() - start)
+        with tempfile.TemporaryDirectory(prefix="tally-benchmark-") as path:
+            filename = os.path.join(path, "ledgers.xlsx")
+            workbook.save(filename)
+            with zipfile.ZipFile(filename) as f:
+                # The document properties hold the time the workbook was saved
+                saved[num_jobs] = {name: f.read(name) for name in f.namelist() if name != "docProps/core.xml"}
+
+    if saved[1] != saved[jobs]:
+        raise Exception("The workbook constructed with " + str(jobs) + " jobs differs from the one constructed with 1")
+    print("The workbook constructed with " + str(jobs) + " jobs is the same as the one constructed with 1")
+
+def benchmark_holdings(tally, num_trades: int, num_codes: int, num_queries: int) -> None:
+    """Time building a HoldingsIndex, then answering each kind of query for random codes and dates.
+
+    """
+    records = []
+    for idx in range(num_codes):
+        records += make_synthetic_trades(tally, "SYN" + str(idx), num_trades, seed=idx)
+    total_trades = num_trades * num_codes
+
+    start = time.perf_counter()
+    index = tally.HoldingsIndex.from_records(records)
+    report("HoldingsIndex.from_records", total_trades, time.perf_counter() - start)
+
+    rng = random.Random(0)
+    first_date = min(record.trade_date for record in records).toordinal()
+    last_date = max(record.trade_date for record in records).toordinal()
+    queries = [(rng.choice(index.codes), datetime.fromordinal(rng.randint(first_date, last_date)))
+        for _ in range(num_queries)]
+    fiscal_years = [tally.fiscal_year_of(date.toordinal()) for code, date in queries]
+    for name, query in [
+            ("holdings", lambda code, date, fiscal_year: index.holdings(code, date)),
+            ("cost_base", lambda code, date, fiscal_year: index.cost_base(code, date)),
+            ("open_lots", lambda code, date, fiscal_year: index.open_lots(code, date)),
+            ("realised_gains", lambda code, date, fiscal_year: index.realised_gains(fiscal_year, [code]))]:
+        start = time.perf_counter()
+        for (code, date), fiscal_year in zip(queries, fiscal_years):
+            query(code, date, fiscal_year)
+        seconds = time.perf_counter() - start
+        print("{:<40} {:>9,} queries {:>8.3f}s {:>12,.0f} queries/s".format(
+            "HoldingsIndex." + name, num_queries, seconds, num_queries / seconds if seconds else float("inf")))
+
+BENCHMARKS = ("lot-matching", "parsing", "pipeline", "startup", "backends", "ledgers", "holdings")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark tally-investment-records.py on synthetic data.")
+    parser.add_argument("benchmarks", nargs="*", metavar="BENCHMARK",
+        help="Benchmarks to run, from " + ", ".join(BENCHMARKS) + " (default: all).")
+    parser.add_argument("--trades", type=int, default=100000, help="Trades per code (default: %(default)s).")
+    parser.add_argument("--codes", type=int, default=1, help="Number of codes (default: %(default)s).")
+    parser.add_argument("--legacy-trades", type=int, default=5000,
+        help="Trades per code given to find_records_to_sell_fifo, which is quadratic (default: %(default)s).")
+    parser.add_argument("--iterations", type=int, default=20000,
+        help="Times each sample text is parsed (default: %(default)s).")
+    parser.add_argument("--scales", type=int, nargs="+", default=[1000, 10000],
+        help="Numbers of records the pipeline is run over (default: %(default)s).")
+    parser.add_argument("--pipeline-codes", type=int, default=20,
+        help="Number of codes traded in the pipeline's contract notes (default: %(default)s).")
+    parser.add_argument("--backend-files", type=int, default=500,
+        help="Number of synthetic files each extraction backend reads (default: %(default)s).")
+    parser.add_argument("--queries", type=int, default=10000,
+        help="Number of each kind of query in the holdings benchmark, over --trades trades of --codes codes "
+            "(default: %(default)s).")
+    parser.add_argument("--ledger-trades", type=int, default=2000,
+        help="Trades per code in the ledgers benchmark (default: %(default)s).")
+    parser.add_argument("--ledger-codes", type=int, default=40,
+        help="Number of codes in the ledgers benchmark (default: %(default)s).")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1,
+        help="Worker processes the ledgers benchmark compares with one (default: one per CPU core, %(default)s).")
+    parser.add_argument("--repeat", type=int, default=3,
+        help="Times the pipeline is run at each scale, keeping each stage's shortest time (default: %(default)s).")
+    parser.add_argument("--output", metavar="FILE", help="Write the pipeline results to FILE as JSON.")
+    parser.add_argument("--baseline", metavar="FILE", help="Compare the pipeline results with those in FILE.")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+        help="Fraction a stage may be slower than the baseline before it is a regression (default: %(default)s).")
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error("unknown benchmark " + name)
+
+    tally = load_tally_module()
+    if not args.benchmarks or "lot-matching" in args.benchmarks:
+        benchmark_lot_matching(tally, args.trades, args.codes, args.legacy_trades)
+    if not args.benchmarks or "parsing" in args.benchmarks:
+        benchmark_parsing(tally, args.iterations)
+    if not args.benchmarks or "startup" in args.benchmarks:
+        benchmark_startup()
+    if not args.benchmarks or "backends" in args.benchmarks:
+        benchmark_backends(tally, args.backend_files)
+    if not args.benchmarks or "ledgers" in args.benchmarks:
+        benchmark_ledgers(tally, args.ledger_trades, args.ledger_codes, args.jobs)
+    if not args.benchmarks or "holdings" in args.benchmarks:
+        benchmark_holdings(tally, args.trades, args.codes, args.queries)
+    if not args.benchmarks or "pipeline" in args.benchmarks:
+        results = benchmark_pipeline(tally, args.scales, args.pipeline_codes, args.legacy_trades, args.repeat)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump({
+                    "python": platform.python_version(),
+                    "platform": platform.platform(),
+                    "date": datetime.now().isoformat(timespec="seconds"),
+                    "results": results
+                }, f, indent=4)
+        if args.baseline:
+            with open(args.baseline) as f:
+                regressions = compare_with_baseline(results, json.load(f)["results"], args.tolerance)
+            if regressions:
+                sys.exit(1)
@@ -0,0 +1,494 @@
+"""Checks of tally-investment-records.py against simple reference implementations, run on synthetic data.
+
+Usage:
+    python check.py [cache] [incremental] [lot-selection] [multi-page] [scan-manifest] [zero-quantity] [exports]
+        [holdings] [oversold]
+
+Each check asserts that a fast path gives the same result as a slower, obviously correct one, or as counts
+worked out from the synthetic data, and prints ok once it passes. Any failure raises an AssertionError. fifo lot selection is checked against
+find_records_to_sell_fifo by the lot-matching benchmark in benchmark.py.
+
+"""
+import argparse
+import csv
+import importlib.util
+import os
+import random
+import sqlite3
+import tempfile
+import zipfile
+from datetime import datetime, timedelta
+
+from benchmark import load_tally_module, make_synthetic_texts, make_synthetic_trades, write_text_pdf
+
+def make_trade(tally, code: str, idx: int, trade_type: str, trade_date: datetime, quantity: float, price: float,
+        brokerage: float = 19.95):
+    return tally.InvestmentRecord.from_fields(
+        "WH_ContractNote_" + code + "_" + str(idx) + ".pdf", tally.WH_CONTRACTNOTE, {
+            "trade_type": trade_type,
+            "trade_date": trade_date,
+            "quantity": quantity,
+            "code": code,
+            "average_price_per_share": price,
+            "brokerage": brokerage
+        })
+
+def check_cache(tally) -> None:
+    texts = make_synthetic_texts(tally, 60, 3, seed=2)
+    # A contract note, read by read_investment_records, and a reinvestment plan advice, read by InvestmentRecord
+    texts = [next(text for text in texts if text[1] == record_type)
+        for record_type in [tally.WH_CONTRACTNOTE, tally.VDGR_REINVESTMENT_PLAN_ADVICE]]
+    with tempfile.TemporaryDirectory() as path:
+        cache = tally.ExtractionCache(os.path.join(path, "cache.sqlite"))
+        tally.enable_profiling()
+
+        def read(filename: str, record_type: int) -> tuple:
+            tally.PROFILER.drain()
+            records = tally.read_investment_records(filename, record_type, cache)
+            stages = tally.PROFILER.drain()
+            return [record.get_fields() for record in records], len(stages.get("extract pypdf2", []))
+
+        try:
+            for name, record_type, text in texts:
+                parser = tally.RECORD_PARSERS[record_type]
+                filename = os.path.join(path, name)
+                write_text_pdf(filename, [text])
+                assert read(filename, record_type) == ([parser.parse(text)], 1), name
+                # Read from the cache without opening the pdf
+                assert read(filename, record_type) == ([parser.parse(text)], 0), name
+
+                # Text cached by an older parser version is parsed again, without being extracted again
+                cache.connection.execute("UPDATE extraction SET parser_version = ? WHERE record_type = ?",
+                    (tally.PARSER_VERSION - 1, record_type))
+                cache.connection.commit()
+                assert read(filename, record_type) == ([parser.parse(text)], 0), name
+                assert cache.get(tally.hash_file(filename), record_type, "pypdf2")[1] == parser.parse(text), name
+
+                # A file whose content changes is read again
+                other_text = next(other for other in make_synthetic_texts(tally, 60, 3, seed=3) if other[1] == record_type)[2]
+                write_text_pdf(filename, [other_text])
+                assert read(filename, record_type) == ([parser.parse(other_text)], 1), name
+                assert read(filename, record_type) == ([parser.parse(other_text)], 0), name
+        finally:
+            tally.enable_profiling(False)
+
+        def count_entries() -> int:
+            return cache.connection.execute("SELECT COUNT(*) FROM extraction").fetchone()[0]
+
+        # Each file's first and second content, and the stale entry of its first content
+        assert count_entries() == 6
+        assert cache.evict() == 2 and count_entries() == 4
+        assert cache.evict(max_entries=3) == 1 and count_entries() == 3
+        assert cache.evict(max_age_days=0) == 3 and count_entries() == 0
+        cache.close()
+
+def write_workbook(tally, filename: str, records: list, incremental: bool) -> list:
+    """Write records to filename as the tally does, returning the codes whose sheets were rebuilt or removed.
+
+    """
+    table = tally.RecordTable.from_records(records)
+    workbook = tally.StreamedWorkbook(filename, "fifo", "formulas")
+    changed_codes = workbook.reuse_sheets(table) if incremental else list(table.by_code)
+    if incremental and not changed_codes:
+        workbook.discard()
+        return changed_codes
+    tally.write_code_ledgers(table, [workbook])
+    workbook.close()
+    return changed_codes
+
+def read_parts(filename: str) -> dict:
+    # The document properties hold the time the workbook was saved
+    with zipfile.ZipFile(filename) as workbook:
+        return {name: workbook.read(name) for name in workbook.namelist() if name != "docProps/core.xml"}
+
+def check_incremental(tally) -> None:
+    def synthetic_trades(num_trades_by_code: dict) -> list:
+        records = []
+        for code, num_trades in num_trades_by_code.items():
+            # Seeded by code, so a code's trades don't depend on which other codes there are
+            records += make_synthetic_trades(tally, code, num_trades, seed=ord(code[0]))
+        return records
+
+    with tempfile.TemporaryDirectory() as path:
+        os.makedirs(os.path.join(path, "incremental"))
+        os.makedirs(os.path.join(path, "full"))
+        filename = os.path.join(path, "incremental", "Investment_Record_Tally.xlsx")
+        full_filename = os.path.join(path, "full", "Investment_Record_Tally.xlsx")
+
+        num_trades_by_code = {"AAA": 60, "BBB": 80, "CCC": 40, "DDD": 70}
+        assert write_workbook(tally, filename, synthetic_trades(num_trades_by_code), False) == list(num_trades_by_code)
+        assert write_workbook(tally, filename, synthetic_trades(num_trades_by_code), True) == []
+
+        # Trades added to one code, and another code removed. A seed gives the same first trades however many there are.
+        num_trades_by_code["BBB"] = 95
+        del num_trades_by_code["CCC"]
+        assert write_workbook(tally, filename, synthetic_trades(num_trades_by_code), True) == ["CCC", "BBB"]
+        write_workbook(tally, full_filename, synthetic_trades(num_trades_by_code), False)
+        assert read_parts(filename) == read_parts(full_filename)
+
+        # A code added, with every other sheet copied but one, which is rebuilt so the styles are laid out the same
+        num_trades_by_code["EEE"] = 30
+        assert write_workbook(tally, filename, synthetic_trades(num_trades_by_code), True) == ["EEE"]
+        write_workbook(tally, full_filename, synthetic_trades(num_trades_by_code), False)
+        assert read_parts(filename) == read_parts(full_filename)
+
+        # A workbook changed since it was written is rebuilt in full
+        os.utime(filename, ns=(10**18, 10**18))
+        assert write_workbook(tally, filename, synthetic_trades(num_trades_by_code), True) == list(num_trades_by_code)
+        assert read_parts(filename) == read_parts(full_filename)
+
+        # Every record removed, leaving only the Summary sheet
+        assert write_workbook(tally, filename, [], True) == list(num_trades_by_code)
+        write_workbook(tally, full_filename, [], False)
+        assert read_parts(filename) == read_parts(full_filename)
+
+def replay_lot_selection(table, rows: list, policy: str) -> list:
+    """Match each row's sale by searching every open lot, returning the (row, quantity) tuples used by each row.
+
+    """
+    open_lots = []
+    remaining = {}
+    matches = []
+    for row in rows:
+        if not table.is_sale(row):
+            open_lots.append(row)
+            remaining[row] = table.quantities[row]
+            matches.append([])
+            continue
+        quantity_to_sell = table.quantities[row]
+        match = []
+        while quantity_to_sell > 0:
+            candidates = [lot_row for lot_row in open_lots if remaining[lot_row] > 0]
+            assert candidates, "synthetic trades never oversell"
+            if policy == "lifo":
+                lot_row = candidates[-1]
+            else:
+                # The highest cost per unit, and of equal costs the lot opened first
+                lot_row = max(candidates, key=lambda candidate: (
+                    table.prices[candidate] + table.brokerages[candidate] / table.quantities[candidate],
+                    -open_lots.index(candidate)))
+            quantity = min(remaining[lot_row], quantity_to_sell)
+            match.append((lot_row, quantity))
+            remaining[lot_row] -= quantity
+            quantity_to_sell -= quantity
+        matches.append(match)
+    return matches
+
+def check_lot_selection(tally) -> None:
+    # Three lots, bought cheap, dear and in between, then a sale of more than one lot
+    start = datetime(2020, 1, 6)
+    records = [make_trade(tally, "ABC", idx, trade_type, start + timedelta(days=idx), quantity, price, 0.0)
+        for idx, (trade_type, quantity, price) in enumerate([
+            ("Buy", 10.0, 1.0), ("Buy", 10.0, 3.0), ("Buy", 10.0, 2.0), ("Sell", 15.0, 4.0)])]
+    expected = {
+        "fifo": [(0, 10.0), (1, 5.0)],
+        "lifo": [(2, 10.0), (1, 5.0)],
+        "highest-cost": [(1, 10.0), (2, 5.0)]
+    }
+    for policy, expected_lots in expected.items():
+        table = tally.RecordTable.from_records(records)
+        rows = table.by_code["ABC"]
+        lot_matcher = tally.LotMatcher(table, policy)
+        for row in rows[:3]:
+            lot_matcher.add_record(row)
+        assert lot_matcher.add_record(rows[3]) == [(rows[lot_idx], quantity) for lot_idx, quantity in expected_lots], policy
+
+    records = []
+    for idx in range(5):
+        records += make_synthetic_trades(tally, "SYN" + str(idx), 400, seed=idx)
+    for policy in ("lifo", "highest-cost"):
+        table = tally.RecordTable.from_records(records)
+        for rows in table.by_code.values():
+            lot_matcher = tally.LotMatcher(table, policy)
+            assert [lot_matcher.add_record(row) for row in rows] == replay_lot_selection(table, rows, policy), policy
+
+def check_multi_page(tally) -> None:
+    texts = [text for filename, record_type, text in make_synthetic_texts(tally, 60, 3, seed=8)
+        if record_type == tally.WH_CONTRACTNOTE][:4]
+    parser = tally.RECORD_PARSERS[tally.WH_CONTRACTNOTE]
+    # The second note runs onto a second page, which doesn't start a note
+    assert "\nPage\n1\n of\n1\n" in texts[1]
+    pages = [texts[0], texts[1].replace("\nPage\n1\n of\n1\n", "\nPage\n1\n of\n2\n"), "Continued\nPage\n2\n of\n2\n", texts[2]]
+    notes = list(tally.split_notes(enumerate(pages, start=1), parser))
+    assert notes == [(1, pages[0]), (2, pages[1] + "\n" + pages[2]), (4, pages[3])]
+    expected = [dict(parser.parse(text), page=page) for page, text in notes]
+
+    with tempfile.TemporaryDirectory() as path:
+        filename = os.path.join(path, "WH_ContractNote_export.pdf")
+        write_text_pdf(filename, pages)
+        single_filename = os.path.join(path, "WH_ContractNote_single.pdf")
+        write_text_pdf(single_filename, [texts[3]])
+        cache = tally.ExtractionCache(os.path.join(path, "cache.sqlite"))
+        tally.enable_profiling()
+        try:
+            for cache_state in ["uncached", "cold", "warm"]:
+                tally.PROFILER.drain()
+                records = tally.read_investment_records(filename, tally.WH_CONTRACTNOTE, None if cache_state == "uncached" else cache)
+                stages = {name: len(samples) for name, samples in tally.PROFILER.drain().items()}
+                assert [record.get_fields() for record in records] == expected, cache_state
+                assert [record.source for record in records] == [filename + "#page=" + str(page) for page, text in notes]
+                # Hashed and looked up once, and read once unless it was cached
+                assert stages.get("hash", 0) == (0 if cache_state == "uncached" else 1), (cache_state, stages)
+                assert stages.get("cache", 0) == {"uncached": 0, "cold": 2, "warm": 1}[cache_state], (cache_state, stages)
+                assert stages.get("extract pypdf2", 0) == (0 if cache_state == "warm" else len(pages)), (cache_state, stages)
+
+                records = tally.read_investment_records(single_filename, tally.WH_CONTRACTNOTE, None if cache_state == "uncached" else cache)
+                assert [record.get_fields() for record in records] == [parser.parse(texts[3])], cache_state
+                assert records[0].source == single_filename
+        finally:
+            tally.enable_profiling(False)
+            cache.close()
+
+def check_scan_manifest(tally) -> None:
+    with tempfile.TemporaryDirectory() as path:
+        root = os.path.join(path, "records")
+        for dirname in ["2020", "2021"]:
+            os.makedirs(os.path.join(root, dirname))
+            for idx in range(3):
+                with open(os.path.join(root, dirname, "WH_ContractNote_" + dirname + "_" + str(idx) + ".pdf"), "w") as f:
+                    f.write("x")
+        with open(os.path.join(root, "notes.txt"), "w") as f:
+            f.write("not a record")
+        # Back date every directory, so a change made now always gives a different mtime
+        for dirpath in [root, os.path.join(root, "2020"), os.path.join(root, "2021")]:
+            os.utime(dirpath, ns=(10**18, 10**18))
+        manifest_filename = os.path.join(path, "scan.json")
+
+        def scan():
+            manifest = tally.ScanManifest(manifest_filename, root)
+            files, changed, removed = manifest.scan(root)
+            manifest.save()
+            assert sorted(files) == sorted(tally.get_investment_record_filenames(root))
+            assert len(set(files)) == len(files)
+            return sorted(filename for filename, record_type in changed), sorted(removed)
+
+        changed, removed = scan()
+        assert changed == sorted(filename for filename, record_type in tally.get_investment_record_filenames(root))
+        assert len(changed) == 6 and removed == []
+        assert scan() == ([], [])
+
+        # A new file, a file rewritten in the same directory, and a file removed from another directory.
+        # The symlink back to the root isn't followed, so nothing is found twice.
+        added = os.path.join(root, "2020", "WH_ContractNote_2020_3.pdf")
+        rewritten = os.path.join(root, "2020", "WH_ContractNote_2020_0.pdf")
+        deleted = os.path.join(root, "2021", "WH_ContractNote_2021_1.pdf")
+        with open(added, "w") as f:
+            f.write("x")
+        with open(rewritten, "w") as f:
+            f.write("longer")
+        os.remove(deleted)
+        os.symlink(root, os.path.join(root, "2020", "loop"))
+        assert scan() == (sorted([added, rewritten]), [deleted])
+        assert scan() == ([], [])
+
+        # A manifest of other filters is ignored, so every file is found again
+        manifest = tally.ScanManifest(manifest_filename, root, exclude=["2021"])
+        files, changed, removed = manifest.scan(root)
+        assert sorted(changed) == sorted(files) and len(files) == 4 and removed == []
+
+def check_zero_quantity(tally) -> None:
+    records = make_synthetic_trades(tally, "ZERO", 60, seed=7)
+    nothing_sold = make_trade(tally, "ZERO", 1000, "Sell", records[30].trade_date, 0.0, 1.0)
+    dates = sorted({record.trade_date for record in records})
+    for policy in tally.LotMatcher.POLICIES:
+        # A sale of nothing raises without using any lots
+        table = tally.RecordTable.from_records(records + [nothing_sold])
+        lot_matcher = tally.LotMatcher(table, policy)
+        for row in table.by_code["ZERO"]:
+            if table.sources[row] != nothing_sold.filename:
+                lot_matcher.add_record(row)
+                continue
+            available = list(table.available)
+            try:
+                lot_matcher.add_record(row)
+            except Exception as e:
+                assert str(e).startswith("No quantity sold in sale record"), str(e)
+            else:
+                assert False, "a sale of nothing was matched"
+            assert list(table.available) == available
+
+        # Otherwise the code's sheet and holdings are as if there were no such sale
+        expected_table = tally.RecordTable.from_records(list(records))
+        _, expected_summaries = tally.compute_code_ledger(expected_table, "ZERO", policy, "values")
+        table = tally.RecordTable.from_records(records + [nothing_sold])
+        ledger, summaries = tally.compute_code_ledger(table, "ZERO", policy, "values")
+        row = next(row for row in table.by_code["ZERO"] if table.sources[row] == nothing_sold.filename)
+        history = ledger.get(table.sheet_rows[row], "History")
+        assert history.startswith("No quantity sold in sale record"), history
+        assert len(summaries) == len(expected_summaries)
+        for summary, expected_summary in zip(summaries, expected_summaries):
+            for column in tally.CAPITAL_GAIN_COLUMNS + ["Net capital gain"]:
+                assert summary[column] == expected_summary[column], (policy, summary["fiscal_year_end"], column)
+
+        expected_index = tally.HoldingsIndex.from_records(list(records), policy)
+        index = tally.HoldingsIndex.from_records(records + [nothing_sold], policy)
+        for date in dates:
+            assert index.holdings("ZERO", date) == expected_index.holdings("ZERO", date), (policy, date)
+            assert index.cost_base("ZERO", date) == expected_index.cost_base("ZERO", date), (policy, date)
+            assert index.open_lots("ZERO", date) == expected_index.open_lots("ZERO", date), (policy, date)
+        for fiscal_year in {tally.fiscal_year_of(date.toordinal()) for date in dates}:
+            assert index.realised_gains(fiscal_year) == expected_index.realised_gains(fiscal_year), (policy, fiscal_year)
+
+def read_export(output_format: str, filename: str) -> tuple:
+    """Return (column names, rows) of an exported file, with empty cells as None.
+
+    """
+    if output_format == "csv":
+        with open(filename, newline="", encoding="utf-8") as f:
+            rows = list(csv.reader(f))
+        return rows[0], [[cell or None for cell in row] for row in rows[1:]]
+    if output_format == "sqlite":
+        connection = sqlite3.connect(filename)
+        try:
+            cursor = connection.execute("SELECT * FROM ledger")
+            return [column[0] for column in cursor.description], [list(row) for row in cursor]
+        finally:
+            connection.close()
+    import pyarrow.parquet
+    table = pyarrow.parquet.read_table(filename)
+    return table.column_names, [list(row.values()) for row in table.to_pylist()]
+
+def check_exports(tally) -> None:
+    records = []
+    for idx in range(3):
+        records += make_synthetic_trades(tally, "SYN" + str(idx), 500, seed=idx)
+    # One row per record, and a subquantity row per lot for sales matched against more than one lot
+    table = tally.RecordTable.from_records(records)
+    expected_codes = {}
+    expected_subquantities = 0
+    for code, rows in table.by_code.items():
+        lot_matcher = tally.LotMatcher(table, "fifo")
+        matches = [lot_matcher.add_record(row) for row in rows]
+        expected_codes[code] = len(rows)
+        expected_subquantities += sum(len(match) for match in matches if len(match) > 1)
+    num_rows = sum(expected_codes.values()) + expected_subquantities
+    assert num_rows > tally.EXPORT_BATCH_ROWS
+
+    # pyarrow is optional, as it is for the tally
+    output_formats = ["csv", "sqlite"] + (["parquet"] if importlib.util.find_spec("pyarrow") else [])
+    with tempfile.TemporaryDirectory() as path:
+        # Exports on their own, and sharing each code's ledger with a workbook of formulas
+        for with_workbook in [False, True]:
+            writers = [tally.StreamedExport(output_format, os.path.join(path, str(with_workbook) + "." + output_format))
+                for output_format in output_formats]
+            if with_workbook:
+                writers.append(tally.StreamedWorkbook(os.path.join(path, "Investment_Record_Tally.xlsx"), "fifo", "formulas"))
+            tally.write_code_ledgers(tally.RecordTable.from_records(list(records)), writers)
+            for writer in writers[:len(output_formats)]:
+                assert writer.close() == num_rows, writer.output_format
+            for writer in writers[len(output_formats):]:
+                writer.close()
+
+        code_idx = tally.COLUMNS["Code"] - 1
+        subquantity_idx = tally.COLUMNS["Subquantity"] - 1
+        for output_format in output_formats:
+            exported = [read_export(output_format, os.path.join(path, str(with_workbook) + "." + output_format))
+                for with_workbook in [False, True]]
+            assert exported[0] == exported[1], output_format
+            column_names, rows = exported[0]
+            assert column_names == list(tally.COLUMNS), output_format
+            assert len(rows) == num_rows, output_format
+            codes = {}
+            for row in rows:
+                if row[code_idx] is not None:
+                    codes[row[code_idx]] = codes.get(row[code_idx], 0) + 1
+                else:
+                    assert row[subquantity_idx] is not None, output_format
+            assert codes == expected_codes, output_format
+            assert len(rows) - sum(codes.values()) == expected_subquantities, output_format
+
+def make_oversold_trades(tally, code: str) -> list:
+    """Return synthetic trades for a code with a sale of more than is held part way through.
+
+    """
+    records = make_synthetic_trades(tally, code, 40, seed=99)
+    last_date = records[-1].trade_date
+    records.append(make_trade(tally, code, 1000, "Sell", last_date + timedelta(days=3), 1e9, 1.0))
+    later = make_synthetic_trades(tally, code, 20, seed=98)
+    for record in later:
+        record.filename = record.filename.replace(".pdf", "_later.pdf")
+        record.trade_date += last_date - later[0].trade_date + timedelta(days=5)
+    return records + later
+
+def check_holdings(tally) -> None:
+    records = []
+    for idx in range(4):
+        records += make_synthetic_trades(tally, "SYN" + str(idx), 300, seed=idx)
+    records += make_oversold_trades(tally, "BAD")
+    rng = random.Random(0)
+    for policy in tally.LotMatcher.POLICIES:
+        index = tally.HoldingsIndex.from_records(list(records), policy)
+        for _ in range(200):
+            code = rng.choice(index.codes)
+            code_records = [record for record in records if record.code == code]
+            first_date = min(record.trade_date for record in code_records).toordinal()
+            last_date = max(record.trade_date for record in code_records).toordinal()
+            date = datetime.fromordinal(rng.randint(first_date - 5, last_date + 5))
+
+            # Replay the code's records up to the date, and read the lots left open from the table
+            expected_lots = []
+            earlier = [record for record in code_records if record.trade_date <= date]
+            if earlier:
+                table = tally.RecordTable.from_records(earlier)
+                lot_matcher = tally.LotMatcher(table, policy)
+                for row in table.by_code[code]:
+                    try:
+                        lot_matcher.add_record(row)
+                    except Exception:
+                        pass
+                expected_lots = [(table.trade_date(row), table.available[row], table.sources[row])
+                    for row in table.by_code[code] if not table.is_sale(row) and table.available[row] > 0]
+
+            lots = index.open_lots(code, date)
+            assert [(lot["Date"], lot["Quantity"], lot["Filename"]) for lot in lots] == expected_lots, (policy, code, date)
+            assert index.holdings(code, date) == sum(quantity for _, quantity, _ in expected_lots), (policy, code, date)
+            cost_base = sum(lot["Cost base"] for lot in lots)
+            assert abs(index.cost_base(code, date) - cost_base) <= 1e-6 * max(1.0, abs(cost_base)), (policy, code, date)
+
+def check_oversold(tally) -> None:
+    records = make_oversold_trades(tally, "BAD")
+    oversold = next(record for record in records if record.filename.endswith("_1000.pdf"))
+    for policy in tally.LotMatcher.POLICIES:
+        table = tally.RecordTable.from_records(list(records))
+        ledger, summaries = tally.compute_code_ledger(table, "BAD", policy, "values")
+        row = next(row for row in table.by_code["BAD"] if table.sources[row] == oversold.filename)
+        history = ledger.get(table.sheet_rows[row], "History")
+        assert history.startswith("Insufficient buy records found for sale record"), history
+
+        # The oversold sale uses up every open lot, and has no gain
+        index = tally.HoldingsIndex.from_records(list(records), policy)
+        assert index.holdings("BAD", oversold.trade_date) == 0.0
+        # Cost bases are running totals, so nothing held may leave a little rounding
+        assert abs(index.cost_base("BAD", oversold.trade_date)) <= 1e-6
+        assert index.open_lots("BAD", oversold.trade_date) == []
+        for summary in summaries:
+            gains = index.realised_gains(summary["fiscal_year_end"], ["BAD"])
+            for column in tally.CAPITAL_GAIN_COLUMNS + ["Net capital gain"]:
+                assert gains[column] == summary[column], (policy, summary["fiscal_year_end"], column)
+
+CHECKS = {
+    "cache": check_cache,
+    "incremental": check_incremental,
+    "lot-selection": check_lot_selection,
+    "multi-page": check_multi_page,
+    "scan-manifest": check_scan_manifest,
+    "zero-quantity": check_zero_quantity,
+    "exports": check_exports,
+    "holdings": check_holdings,
+    "oversold": check_oversold
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check tally-investment-records.py against reference implementations.")
+    parser.add_argument("checks", nargs="*", metavar="CHECK",
+        help="Checks to run, from " + ", ".join(CHECKS) + " (default: all).")
+    args = parser.parse_args()
+    for name in args.checks:
+        if name not in CHECKS:
+            parser.error("unknown check " + name)
+
+    tally = load_tally_module()
+    for name, check in CHECKS.items():
+        if not args.checks or name in args.checks:
+            check(tally)
+            print("ok " + name)
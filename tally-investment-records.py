@@ -1,23 +1,36 @@
-import PyPDF2
-import openpyxl
-from openpyxl.styles.numbers import BUILTIN_FORMATS
-import textract
 import re
 from re import Match
 import os
-from typing import List
+from typing import List, TYPE_CHECKING
 import sys
-from openpyxl import Workbook
-from openpyxl.worksheet.worksheet import Worksheet
-from openpyxl.utils import cell
-from openpyxl.worksheet.dimensions import ColumnDimension
-from collections import defaultdict
-from datetime import datetime, timedelta
+from collections import defaultdict, deque
+import heapq
+from datetime import datetime
 import os.path
 from operator import attrgetter, truediv
-import fiscalyear
-from fiscalyear import FiscalDateTime
-from progress.bar import ChargingBar
+from array import array
+from bisect import bisect_right
+import argparse
+import fnmatch
+import hashlib
+import json
+import csv
+import sqlite3
+import shutil
+import threading
+import time
+import zipfile
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
+from contextlib import contextmanager, nullcontext
+from itertools import chain, islice
+
+# PyPDF2, openpyxl, fiscalyear and progress are imported where they are first used, so that a run only
+# loads what it needs (e.g. --help loads none of them, and a csv export doesn't load openpyxl)
+if TYPE_CHECKING:
+    from openpyxl import Workbook
+    from openpyxl.worksheet.worksheet import Worksheet
+    from progress.bar import ChargingBar
 
 # We can handle the following record types as input (all pdfs)
 WH_CONTRACTNOTE = 0
@@ -48,209 +61,1373 @@ for name, format_data in [
     FORMAT[name] = format_data
 del idx
 
-# In Australia, the financial year begins on 1 July
-# Fiscal year is represented by the year of its end date
-fiscalyear.setup_fiscal_calendar('previous', 7, 1)
+def get_column_letter(column_idx: int) -> str:
+    """Return the letters of a spreadsheet column numbered from 1, as openpyxl.utils.cell.get_column_letter does.
+
+    """
+    letters = ""
+    while column_idx > 0:
+        column_idx, remainder = divmod(column_idx - 1, 26)
+        letters = chr(ord("A") + remainder) + letters
+    return letters
+
+# Bump this whenever a parsing change would produce different fields from the same pdf text,
+# so that entries written to the extraction cache by older versions are parsed again
+PARSER_VERSION = 2
+
+class Profiler():
+    """Collects the duration of every call of each instrumented stage of a run, such as parsing or saving.
+
+    Each sample is a (seconds, label) tuple, where the label optionally says what the stage was working on.
+    Worker processes have their own profiler, whose samples are sent back with each file's records.
+
+    """
+
+    def __init__(self) -> None:
+        self.samples = defaultdict(list)
+
+    @contextmanager
+    def stage(self, name: str, label=None):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.samples[name].append((time.perf_counter() - start, label))
+
+    def drain(self) -> dict:
+        """Return the samples collected so far, and start collecting afresh.
+
+        """
+        samples = dict(self.samples)
+        self.samples = defaultdict(list)
+        return samples
+
+    def merge(self, samples: dict) -> None:
+        for name, stage_samples in samples.items():
+            self.samples[name].extend(stage_samples)
+
+    def report(self, top: int = 10) -> dict:
+        """Return the count, total, p50, p95 and max seconds of each stage, the slowest top files and peak memory.
+
+        """
+        stages = {}
+        for name, stage_samples in self.samples.items():
+            seconds = sorted(sample[0] for sample in stage_samples)
+            stages[name] = {
+                "count": len(seconds),
+                "total": sum(seconds),
+                "p50": percentile(seconds, 50),
+                "p95": percentile(seconds, 95),
+                "max": seconds[-1]
+            }
+        slowest_files = sorted(self.samples.get("file", []), key=lambda sample: sample[0], reverse=True)[:top]
+        return {
+            "stages": stages,
+            "slowest_files": [
+                {"seconds": seconds, "filename": filename, "record_type": record_type}
+                for seconds, (filename, record_type) in slowest_files],
+            "peak_memory_bytes": peak_memory()
+        }
+
+def percentile(sorted_values: list, percent: float) -> float:
+    # Nearest rank, so the result is always one of the values
+    rank = -(-len(sorted_values) * percent // 100)
+    return sorted_values[max(0, int(rank) - 1)]
+
+def peak_memory() -> dict:
+    """Return the peak resident memory in bytes of this process and of its largest worker process.
+
+    Values are None where the resource module isn't available (e.g. on Windows).
+
+    """
+    try:
+        import resource
+    except ImportError:
+        return {"main": None, "workers": None}
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    scale = 1 if sys.platform == "darwin" else 1024
+    return {
+        "main": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+        "workers": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale
+    }
+
+def format_profile_report(report: dict) -> str:
+    lines = ["{:<36} {:>8} {:>10} {:>10} {:>10} {:>10}".format("Stage", "Count", "Total", "p50", "p95", "Max")]
+    for name, stage in sorted(report["stages"].items(), key=lambda item: item[1]["total"], reverse=True):
+        lines.append("{:<36} {:>8} {:>9.3f}s {:>9.4f}s {:>9.4f}s {:>9.4f}s".format(
+            name, stage["count"], stage["total"], stage["p50"], stage["p95"], stage["max"]))
+    if report["slowest_files"]:
+        lines.append("")
+        lines.append("Slowest files:")
+        for slow_file in report["slowest_files"]:
+            lines.append("{:8.3f}s  {:<30}  {}".format(slow_file["seconds"], slow_file["record_type"], slow_file["filename"]))
+    lines.append("")
+    for process, peak in report["peak_memory_bytes"].items():
+        if peak is not None:
+            lines.append("Peak memory ({}): {:.1f} MB".format(process, peak / (1 << 20)))
+    return "\n".join(lines)
+
+# Set with enable_profiling, which also runs in each worker process. None when the run isn't profiled.
+PROFILER = None
+_NOT_PROFILED = nullcontext()
+
+def enable_profiling(enabled: bool = True) -> None:
+    global PROFILER
+    PROFILER = Profiler() if enabled else None
+
+def profile_stage(name: str, label=None):
+    """Return a context manager that times a stage of the run if it is being profiled, and does nothing otherwise.
+
+    """
+    return PROFILER.stage(name, label) if PROFILER is not None else _NOT_PROFILED
+
+def parse_quantity(value: str) -> float:
+    return float(value.replace(",", ""))
+
+def parse_dollars(value: str) -> float:
+    return float(value.replace("$", ""))
+
+def date_parser(date_format: str):
+    """Return a conversion that parses a date string in the given strptime format.
+
+    """
+    def parse_date(value: str) -> datetime:
+        return datetime.strptime(value, date_format)
+    return parse_date
+
+class RecordParser():
+    """Declares how to find the fields of one record type in the text of its pdf.
+
+    Patterns are compiled once, and each holds one or more named groups that become fields of the record.
+    They are listed in the order the fields appear in the document, and each search starts from the end of
+    the previous match, so the text is scanned in a single forward pass. A pattern that isn't found after
+    that point is searched for again from the start of the text, so an unusual layout costs time rather than
+    fields. Patterns whose matches would overlap must be combined into one pattern.
+
+    Args:
+        name: Name of the record type, used in messages.
+        filename_pattern: Regular expression matching the full filename of pdfs of this type.
+        patterns: Regular expressions with named groups, in document order.
+        conversions: Dict of field name: function converting the matched string to its final value.
+        constants: Dict of field name: value for fields that are the same for every record of this type.
+        fallbacks: Dict of field name: name of another field to use if the first wasn't found.
+        expected_prefix: If given, text that doesn't start with this is rejected as the wrong format.
+        page_marker: Regular expression with a named group "page" matching the "Page N of M" marker
+            of a document. Together with expected_prefix, this is used to find where each note starts
+            in a multi-page pdf. Types with neither only accept single-page pdfs.
+
+    """
+
+    # Every record type must provide these fields
+    REQUIRED_FIELDS = ("trade_type", "trade_date", "quantity", "code", "average_price_per_share", "brokerage")
+
+    def __init__(self, name: str, filename_pattern: str, patterns: list, conversions: dict = None,
+            constants: dict = None, fallbacks: dict = None, expected_prefix: str = None, page_marker: str = None) -> None:
+        self.name = name
+        self.filename_pattern = re.compile(filename_pattern)
+        self.patterns = [re.compile(pattern) for pattern in patterns]
+        self.conversions = conversions or {}
+        self.constants = constants or {}
+        self.fallbacks = fallbacks or {}
+        self.expected_prefix = expected_prefix
+        self.page_marker = re.compile(page_marker) if page_marker else None
+
+    def can_split_pages(self) -> bool:
+        return self.page_marker is not None or self.expected_prefix is not None
+
+    def starts_note(self, page_text: str) -> bool:
+        """Return True if a page of a multi-page pdf is the first page of a note.
+
+        """
+        if self.page_marker is not None:
+            match = self.page_marker.search(page_text)
+            if match:
+                return int(match.group("page")) == 1
+        return self.expected_prefix is not None and page_text.startswith(self.expected_prefix)
+
+    def can_parse(self, text: str) -> bool:
+        try:
+            self.parse(text)
+        except Exception:
+            return False
+        return True
+
+    def parse(self, text: str, filename: str = "") -> dict:
+        """Return a dict of the fields found in text, with conversions applied.
+
+        """
+        if self.expected_prefix is not None and not text.startswith(self.expected_prefix):
+            raise Exception("Unexpected format for " + self.name + " file " + filename)
+
+        fields = dict(self.constants)
+        pos = 0
+        for pattern in self.patterns:
+            match = pattern.search(text, pos)
+            if match:
+                pos = match.end()
+            else:
+                match = pattern.search(text)
+                if not match:
+                    continue
+            for name, value in match.groupdict().items():
+                if value is not None:
+                    fields[name] = value
+
+        for name, fallback in self.fallbacks.items():
+            if name not in fields and fallback in fields:
+                fields[name] = fields[fallback]
+        for name in self.REQUIRED_FIELDS:
+            if name not in fields:
+                raise Exception("Could not find " + name + " in " + self.name + " file " + filename)
+        for name, conversion in self.conversions.items():
+            if name in fields:
+                fields[name] = conversion(fields[name])
+        return fields
+
+# Record type: RecordParser. New record types are supported by registering a parser for them.
+RECORD_PARSERS = {}
+
+def register_record_parser(record_type: int, parser: RecordParser) -> None:
+    RECORD_PARSERS[record_type] = parser
+
+register_record_parser(WH_CONTRACTNOTE, RecordParser(
+    # We can handle nabTrade Contract Notes
+    "WH_ContractNote",
+    r"WH_ContractNote_.+\.pdf",
+    [
+        r"\n(?P<trade_type>.+) [Cc]onfirmation",
+        r"Trade date:\n(?P<trade_date>.+)",
+        r"As at date:\n(?P<as_at_date>.+)",
+        r"Settlement date:\n(?P<settlement_date>.+)",
+        r"Confirmation number:\n(?P<confirmation_number>.+)",
+        r"Account number:\n(?P<account_number>.+)",
+        r"HIN:\n(?P<hin>.+)",
+        r"Consideration\n(?P<quantity>.+)\n(?P<code>.+)\n(?P<security_description>[^$]+)(?P<average_price_per_share>.+)\n(?P<consideration>.+)\n",
+        r"Brokerage\n(?P<brokerage>.+)"
+    ],
+    conversions={
+        "trade_date": date_parser("%d/%m/%Y"),
+        "quantity": parse_quantity,
+        "average_price_per_share": parse_dollars,
+        "brokerage": parse_dollars
+    },
+    # mFund transactions omit Trade date, so use a suitable substitute
+    fallbacks={"trade_date": "as_at_date"},
+    # These will have a first line of text as follows
+    expected_prefix="WealthHub Securities Limited",
+    page_marker=r"\nPage\n(?P<page>\d+)\n of\n(?P<pages>\d+)\n"))
+
+register_record_parser(FAIR_DISTRIBUTION_ADVICE, RecordParser(
+    "FAIR_Distribution_Advice",
+    r"FAIR_Distribution_Advice_.+\.pdf",
+    # The text is a single line, so matches are lazy to stop at the next label rather than the end of the document
+    [
+        r"This amount has been applied to (?P<quantity>.+?) units at (?P<average_price_per_share>.+?) per unit",
+        r"ASX Code: (?P<code>.+?)Distribution Advice",
+        r"Payment date:(?P<trade_date>.+?)Record date:"
+    ],
+    conversions={
+        "trade_date": date_parser("%d %B %Y"),
+        "quantity": parse_quantity,
+        "average_price_per_share": parse_dollars
+    },
+    constants={"trade_type": "DRP", "brokerage": 0.0},
+    # These will have a first line of text as follows
+    expected_prefix="Class"))
+
+register_record_parser(VDGR_REINVESTMENT_PLAN_ADVICE, RecordParser(
+    "VDGR_Reinvestment_Plan_Advice",
+    r"VDGR_Reinvestment_Plan_Advice_.+\.pdf",
+    [
+        # OCR output may or may not have Windows line endings
+        r"Payment Date (?P<trade_date>.+?)\r?\n",
+        r"Amount applied to (?P<quantity>.+) ETF securities allotted @ (?P<average_price_per_share>.+) each"
+    ],
+    conversions={
+        "trade_date": date_parser("%d %B %Y"),
+        "quantity": parse_quantity,
+        "average_price_per_share": parse_dollars
+    },
+    # OCR doesn't reliably read the ASX Code, so it is fixed for this record type
+    constants={"trade_type": "DRP", "code": "VDGR.ASX", "brokerage": 0.0}))
+
+# Some record types can only be read with OCR. For these, the pdf text layer is tried first,
+# then only the regions of the first page that hold the fields are OCRed, then the whole page.
+# Regions are (left, top, right, bottom) as fractions of the page size.
+OCR_REGIONS = {
+    VDGR_REINVESTMENT_PLAN_ADVICE: [
+        # Record Date and Payment Date, in the top right block
+        (0.45, 0.15, 1.0, 0.45),
+        # "Amount applied to N ETF securities allotted @ $X each", in the DRP details
+        (0.0, 0.5, 1.0, 0.9)
+    ]
+}
+# Resolution pages are rasterized at for OCR, and the number of tesseract processes run at once.
+# Set with configure_ocr, which also runs in each worker process.
+OCR_DPI = 200
+OCR_WORKERS = max(1, (os.cpu_count() or 2) // 2)
+_ocr_executor = None
+
+def configure_ocr(dpi: int = None, workers: int = None) -> None:
+    global OCR_DPI, OCR_WORKERS, _ocr_executor
+    if dpi:
+        OCR_DPI = dpi
+    if workers:
+        OCR_WORKERS = workers
+    if _ocr_executor is not None:
+        _ocr_executor.shutdown()
+        _ocr_executor = None
+    if OCR_WORKERS > 1:
+        # Tesseract is multithreaded itself, which only slows things down when several run at once
+        os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+
+def get_ocr_executor() -> ThreadPoolExecutor:
+    # Tesseract runs as a subprocess, so threads are enough to run several at once
+    global _ocr_executor
+    if _ocr_executor is None:
+        _ocr_executor = ThreadPoolExecutor(max_workers=OCR_WORKERS)
+    return _ocr_executor
+
+@lru_cache(maxsize=8)
+def rasterize_page(filename: str, page_number: int, dpi: int):
+    """Return a PIL image of one page of a pdf, numbered from 1.
+
+    Images are kept for reuse within a run, so falling back from region OCR to whole page OCR
+    doesn't rasterize the page again.
+
+    """
+    # Use OCR as PyPDF2 can't extract text from these
+    # Dependencies required to be installed separately and put in PATH:
+    #   tesseract-ocr-w64-setup-v5.0.0-alpha.20200328 
+    #   poppler
+    # Instructions:
+    #   https://medium.com/quantrium-tech/installing-and-using-tesseract-4-on-windows-10-4f7930313f82 
+    #   https://chadrick-kwag.net/install-poppler-in-windows/
+    # Binaries:
+    #   https://digi.bib.uni-mannheim.de/tesseract/
+    #   https://github.com/oschwartz10612/poppler-windows/releases/
+    # Copies of these binaries and instructions are also kept in the current repository's lib folder
+    # The pdf2image and pytesseract python packages are only imported when OCR is needed
+    import pdf2image
+    return pdf2image.convert_from_path(filename, dpi=dpi, first_page=page_number, last_page=page_number)[0]
+
+def ocr_image(image) -> str:
+    import pytesseract
+    return pytesseract.image_to_string(image, lang="eng")
+
+def ocr_page_regions(filename: str, regions: list, page_number: int = 1, dpi: int = None) -> str:
+    """Return the OCR text of regions of a pdf page, one region after another.
+
+    Args:
+        filename: The pdf file.
+        regions: List of (left, top, right, bottom) fractions of the page size.
+        page_number: The page to read, numbered from 1.
+        dpi: Resolution to rasterize the page at. Defaults to OCR_DPI.
+
+    """
+    image = rasterize_page(filename, page_number, dpi or OCR_DPI)
+    width, height = image.size
+    crops = [image.crop((int(left * width), int(top * height), int(right * width), int(bottom * height)))
+        for left, top, right, bottom in regions]
+    return "\n".join(get_ocr_executor().map(ocr_image, crops))
+
+def ocr_page(filename: str, page_number: int = 1, dpi: int = None) -> str:
+    image = rasterize_page(filename, page_number, dpi or OCR_DPI)
+    return get_ocr_executor().submit(ocr_image, image).result()
 
 class InvestmentRecord():
     """Holds data for a single investment event, such as a sell or a buy.
 
     """
 
-    def __init__(self, filename: str, record_type: int) -> None:
+    # Attributes describing how a record was read, rather than what was read, which aren't cached
+    EXTRACTION_ATTRIBUTES = ("filename", "record_type", "ocr_method", "ocr_seconds")
+
+    # Defaults for records that weren't read from a multi-page pdf, or didn't need OCR
+    page = None
+    ocr_method = None
+    ocr_seconds = 0.0
+
+    def __init__(self, filename: str, record_type: int, cache: "ExtractionCache" = None) -> None:
         self.filename = filename
         self.record_type = record_type
-        self.populate()
-
-    def populate_WH_ContractNote(self, text: str) -> None:
-        # We can handle nabTrade Contract Notes
-        # These will have a first line of text as follows
-        if not text.startswith("WealthHub Securities Limited"):
-            raise Exception("Unexpected format for WH_ContractNote file " + self.filename)
-
-        self.trade_type = re.search(r"\n(.+) [Cc]onfirmation", text).group(1)
-        # mFund transactions omit Trade date, so use a suitable substitute
-        trade_date = re.search(r"Trade date:\n(.+)", text)
-        if(trade_date):
-            self.trade_date = trade_date.group(1)
-        else:
-            self.trade_date = re.search(r"As at date:\n(.+)", text).group(1)
-        self.settlement_date = re.search(r"Settlement date:\n(.+)", text).group(1)
-        self.confirmation_number = re.search(r"Confirmation number:\n(.+)", text).group(1)
-        self.account_number = re.search(r"Account number:\n(.+)", text).group(1)
-        self.hin = re.search(r"HIN:\n(.+)", text).group(1)
-        # details holds multiple named groups in one big match
-        details = re.search(
-            r"Consideration\n(?P<quantity>.+)\n(?P<code>.+)\n(?P<security_description>[^$]+)(?P<average_price>.+)\n(?P<consideration>.+)\n", 
-            text)
-        self.quantity = details.group("quantity")
-        self.code = details.group("code")
-        self.average_price_per_share = details.group("average_price")
-        self.brokerage = re.search(r"Brokerage\n(.+)", text).group(1)
-
-        # Data type conversions for this record type
-        self.trade_date = datetime.strptime(self.trade_date,"%d/%m/%Y")
-
-    def populate_VDGR_Reinvestment_Plan_Advice(self, text: str) -> None:
-        self.trade_type = "DRP"
-        self.trade_date = re.search(r"Payment Date (.+)\r", text).group(1)
-        self.quantity = re.search(r"Amount applied to (.+) ETF securities", text).group(1)
-        '''self.code = re.search(r"ASX Code (.+)", text).group(1)'''
-        self.code = "VDGR.ASX"
-        self.average_price_per_share = re.search(r"securities allotted @ (.+) each", text).group(1)
-        self.brokerage = "0"
-
-        # Data type conversions for this record type
-        self.trade_date = datetime.strptime(self.trade_date,"%d %B %Y")
-
-
-    def populate_FAIR_Distribution_Advice(self, text: str) -> None:
-        # These will have a first line of text as follows
-        if not text.startswith("Class"):
-            raise Exception("Unexpected format for FAIR_Distribution_Advice file " + self.filename)
-
-        self.trade_type = "DRP"
-        self.trade_date = re.search(r"Payment date:(.+)Record date:", text).group(1)
-        self.quantity = re.search(r"This amount has been applied to (.+) units at ", text).group(1)
-        self.code = re.search(r"ASX Code: (.+)Distribution Advice", text).group(1)
-        self.average_price_per_share = re.search(r"units at (.+) per unit", text).group(1)
-        self.brokerage = "0"
-
-        # Data type conversions for this record type
-        self.trade_date = datetime.strptime(self.trade_date,"%d %B %Y")
-
-    def populate(self) -> None:
+        self.populate(cache)
+
+    @classmethod
+    def from_fields(cls, filename: str, record_type: int, fields: dict) -> "InvestmentRecord":
+        """Return a record built from already parsed fields, without reading any file.
+
+        """
+        record = cls.__new__(cls)
+        record.filename = filename
+        record.record_type = record_type
+        vars(record).update(fields)
+        return record
+
+    @classmethod
+    def from_text(cls, filename: str, record_type: int, text: str, page: int = None) -> "InvestmentRecord":
+        """Return a record parsed from text that has already been extracted, such as one note of a multi-page pdf.
+
+        Args:
+            filename: The pdf file the text came from.
+            record_type: The record type, used to choose a parser.
+            text: The text to parse.
+            page: The page of the pdf that the record starts on, if the pdf holds several records.
+
+        """
+        record = cls.from_fields(filename, record_type, {} if page is None else {"page": page})
+        record.parse_text(text)
+        return record
+
+    @property
+    def source(self) -> str:
+        """The filename, plus the page the record starts on if it came from a multi-page pdf.
+
+        """
+        return self.filename if self.page is None else self.filename + "#page=" + str(self.page)
+
+    def extract_text_layer(self) -> str:
+        # Multi-page pdfs are read by read_investment_records instead
+        return get_extraction_backend(self.record_type).extract_single_page(self.filename)
+
+    def extract_text(self) -> str:
+        """Return the text content of this record's pdf file.
+
+        For record types in OCR_REGIONS, the method that produced the text is stored in ocr_method
+        and the time spent on OCR in ocr_seconds.
+
+        """
+        if self.record_type not in OCR_REGIONS:
+            return self.extract_text_layer()
+
+        parser = RECORD_PARSERS[self.record_type]
+        try:
+            text = self.extract_text_layer()
+        except MissingTextError:
+            # Treated like a scan without a text layer
+            text = ""
+        self.ocr_method = "text layer"
+        if parser.can_parse(text):
+            return text
+
+        start = time.perf_counter()
+        try:
+            with profile_stage("ocr"):
+                text = ocr_page_regions(self.filename, OCR_REGIONS[self.record_type])
+                self.ocr_method = "regions"
+                if not parser.can_parse(text):
+                    text = ocr_page(self.filename)
+                    self.ocr_method = "page"
+        finally:
+            self.ocr_seconds = time.perf_counter() - start
+        return text
+
+    def parse_text(self, text: str) -> None:
+        """Populate instance variables from the text content of a pdf file.
+
+        """
+        parser = RECORD_PARSERS[self.record_type]
+        with profile_stage("parse " + parser.name):
+            vars(self).update(parser.parse(text, self.filename))
+
+    def get_fields(self) -> dict:
+        """Return the parsed fields of this record, i.e. everything except EXTRACTION_ATTRIBUTES.
+
+        """
+        return {name: value for name, value in vars(self).items() if name not in self.EXTRACTION_ATTRIBUTES}
+
+    def populate(self, cache: "ExtractionCache" = None) -> None:
         """Populate instance variables from a pdf file.
 
         Args:
-            filename: The pdf file containing data for population.
+            cache: Optional extraction cache. Files already in the cache are not read or parsed again.
             
         """
         # Ensure requested file has a pdf extension
         if not self.filename.endswith(".pdf"):
             raise ValueError("Input file must have extension .pdf")
-        
-        if(self.record_type == VDGR_REINVESTMENT_PLAN_ADVICE):
-            # Use OCR as PyPDF2 can't extract text from these
-            # Dependencies required to be installed separately and put in PATH:
-            #   tesseract-ocr-w64-setup-v5.0.0-alpha.20200328 
-            #   poppler
-            # Instructions:
-            #   https://medium.com/quantrium-tech/installing-and-using-tesseract-4-on-windows-10-4f7930313f82 
-            #   https://chadrick-kwag.net/install-poppler-in-windows/
-            # Binaries:
-            #   https://digi.bib.uni-mannheim.de/tesseract/
-            #   https://github.com/oschwartz10612/poppler-windows/releases/
-            # Copies of these binaries and instructions are also kept in the current repository's lib folder
-
-            text = textract.process(self.filename, method='tesseract', language='eng').decode("utf-8")
+        if cache is None:
+            self.parse_text(self.extract_text())
+            return
+
+        backend = get_extraction_backend(self.record_type)
+        content_hash = backend.content_hash(self.filename)
+        text, fields = cache.get(content_hash, self.record_type, backend.name)
+        if isinstance(fields, list):
+            # Fields of each note of a multi-page pdf, cached by read_investment_records
+            raise MultiPagePdfError("Only single-page pdfs are accepted")
+        if fields is not None:
+            vars(self).update(fields)
+            return
+
+        # Text cached by an older parser version can be parsed again without re-reading the pdf
+        if text is None:
+            text = self.extract_text()
+        self.parse_text(text)
+        cache.put(content_hash, self.record_type, backend.name, text, self.get_fields())
+
+
+class MultiPagePdfError(Exception):
+    pass
+
+class MissingTextError(Exception):
+    pass
+
+class PyPdf2Backend():
+    """Extracts the text layer of a pdf with PyPDF2.
+
+    """
+
+    name = "pypdf2"
+
+    def content_hash(self, filename: str) -> str:
+        return hash_file(filename)
+
+    def extract_single_page(self, filename: str) -> str:
+        """Return the text of a single-page pdf, raising MultiPagePdfError if it has more than one page.
+
+        """
+        import PyPDF2
+        with profile_stage("extract " + self.name), open(filename, "rb") as f:
+            pdf_reader = PyPDF2.PdfFileReader(f)
+
+            if pdf_reader.numPages > 1:
+                raise MultiPagePdfError("Only single-page pdfs are accepted")
+
+            # Get all the data we want
+            return pdf_reader.getPage(0).extractText()
+
+    def iter_page_texts(self, filename: str):
+        """Yield (page number, text) for each page of a pdf, numbered from 1.
+
+        The pdf is opened once and each page is only read and extracted when it is asked for.
+
+        """
+        import PyPDF2
+        with open(filename, "rb") as f:
+            pdf_reader = PyPDF2.PdfFileReader(f)
+            for page_idx in range(pdf_reader.numPages):
+                with profile_stage("extract " + self.name):
+                    text = pdf_reader.getPage(page_idx).extractText()
+                yield page_idx + 1, text
 
+class PreExtractedTextBackend():
+    """Reads text extracted from a pdf beforehand, from a file named like the pdf with .txt added.
+
+    The text must be laid out as PyPDF2 extracts it (as the sample_data texts are), since that is what the
+    record parsers expect. The pages of a multi-page pdf are separated by form feeds.
+
+    """
+
+    name = "text"
+    SUFFIX = ".txt"
+
+    def content_hash(self, filename: str) -> str:
+        """Return a hash of the pdf and its text file together, so a change to either one is read again.
+
+        The pdf is included as record types in OCR_REGIONS fall back to OCR of it if the text can't be parsed.
+
+        """
+        sha = hashlib.sha256(hash_file(filename).encode())
+        text_filename = filename + self.SUFFIX
+        if os.path.isfile(text_filename):
+            sha.update(hash_file(text_filename).encode())
+        return sha.hexdigest()
+
+    def read_pages(self, filename: str) -> list:
+        text_filename = filename + self.SUFFIX
+        if not os.path.isfile(text_filename):
+            raise MissingTextError("No pre-extracted text file " + text_filename)
+        with profile_stage("extract " + self.name), open(text_filename, encoding="utf-8") as f:
+            pages = f.read().split("\f")
+        # Allow the last page to end with a form feed
+        if len(pages) > 1 and not pages[-1]:
+            pages.pop()
+        return pages
+
+    def extract_single_page(self, filename: str) -> str:
+        pages = self.read_pages(filename)
+        if len(pages) > 1:
+            raise MultiPagePdfError("Only single-page pdfs are accepted")
+        return pages[0]
+
+    def iter_page_texts(self, filename: str):
+        for page_idx, text in enumerate(self.read_pages(filename)):
+            yield page_idx + 1, text
+
+# Backend name: backend. New ways of getting the text of a record's file are supported by registering
+# a backend with content_hash, extract_single_page and iter_page_texts methods. content_hash must change
+# whenever the text the backend would extract does, as it keys the extraction cache.
+EXTRACTION_BACKENDS = {}
+
+def register_extraction_backend(backend) -> None:
+    EXTRACTION_BACKENDS[backend.name] = backend
+
+register_extraction_backend(PyPdf2Backend())
+register_extraction_backend(PreExtractedTextBackend())
+
+# The backend used for each record type, with the None entry used for record types not listed.
+# Set with configure_extraction_backends, which also runs in each worker process.
+# Record types in OCR_REGIONS fall back to OCR if their backend's text can't be parsed.
+RECORD_EXTRACTION_BACKENDS = {None: "pypdf2"}
+
+def configure_extraction_backends(backends: dict) -> None:
+    """Choose the extraction backend of each record type.
+
+    Args:
+        backends: Dict of record type: backend name. A None key sets the backend of every record type not listed.
+
+    """
+    for record_type, name in backends.items():
+        if name not in EXTRACTION_BACKENDS:
+            raise ValueError("Unknown extraction backend " + name)
+        RECORD_EXTRACTION_BACKENDS[record_type] = name
+
+def get_extraction_backend(record_type: int):
+    return EXTRACTION_BACKENDS[RECORD_EXTRACTION_BACKENDS.get(record_type, RECORD_EXTRACTION_BACKENDS[None])]
+
+def split_notes(page_texts, parser: RecordParser):
+    """Yield (first page number, text) for each note in a sequence of (page number, text) pages.
+
+    Only the pages of the current note are held at once.
+
+    """
+    note_pages = []
+    first_page = None
+    for page_number, text in page_texts:
+        if note_pages and parser.starts_note(text):
+            yield first_page, "\n".join(note_pages)
+            note_pages = []
+        if not note_pages:
+            first_page = page_number
+        note_pages.append(text)
+    if note_pages:
+        yield first_page, "\n".join(note_pages)
+
+def read_investment_records(filename: str, record_type: int, cache: "ExtractionCache" = None) -> list:
+    """Return the records held in a pdf file.
+
+    A single-page pdf holds one record. A multi-page pdf, such as a yearly export of contract notes,
+    is split into notes where its record type's parser finds a first page, giving one record per note.
+    The extraction cache holds the fields of every note of a multi-page pdf, but not its text.
+
+    For record types that can be split, the pdf is hashed, looked up in the cache and opened at most once,
+    whether it turns out to have one page or many. None of them are OCR'd, so their text is always read by
+    the backend's iter_page_texts.
+
+    """
+    parser = RECORD_PARSERS[record_type]
+    if not parser.can_split_pages():
+        return [InvestmentRecord(filename, record_type, cache)]
+    if not filename.endswith(".pdf"):
+        raise ValueError("Input file must have extension .pdf")
+
+    backend = get_extraction_backend(record_type)
+    text = None
+    if cache is not None:
+        content_hash = backend.content_hash(filename)
+        text, fields = cache.get(content_hash, record_type, backend.name)
+        if isinstance(fields, list):
+            return [InvestmentRecord.from_fields(filename, record_type, note_fields) for note_fields in fields]
+        if fields is not None:
+            return [InvestmentRecord.from_fields(filename, record_type, fields)]
+
+    # Text cached by an older parser version can be parsed again without re-reading the pdf.
+    # Multi-page pdfs have no cached text, so are read again.
+    page_texts = iter([(1, text)]) if text else backend.iter_page_texts(filename)
+    first_pages = list(islice(page_texts, 2))
+    if len(first_pages) < 2:
+        # A single page holds a single record. A pdf without any fails to parse, as it would as a single page.
+        text = first_pages[0][1] if first_pages else ""
+        record = InvestmentRecord.from_text(filename, record_type, text)
+        if cache is not None:
+            cache.put(content_hash, record_type, backend.name, text, record.get_fields())
+        return [record]
+
+    records = []
+    for page, text in split_notes(chain(first_pages, page_texts), parser):
+        try:
+            records.append(InvestmentRecord.from_text(filename, record_type, text, page))
+        except Exception as e:
+            raise Exception("Page " + str(page) + ": " + str(e))
+
+    if cache is not None:
+        cache.put(content_hash, record_type, backend.name, "", [record.get_fields() for record in records])
+    return records
+
+def hash_file(filename: str) -> str:
+    """Return the sha256 hex digest of a file's content.
+
+    """
+    sha = hashlib.sha256()
+    with profile_stage("hash"), open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def _encode_field(value):
+    if isinstance(value, datetime):
+        return {"datetime": value.isoformat()}
+    raise TypeError("Cannot store " + type(value).__name__ + " in the extraction cache")
+
+def _decode_field(value: dict):
+    if len(value) == 1 and "datetime" in value:
+        return datetime.fromisoformat(value["datetime"])
+    return value
+
+class ExtractionCache():
+    """Persistent store of pdf text and parsed fields, held in a local SQLite file.
+
+    Contract notes never change once issued, so entries are keyed by the content hash of the file given by
+    its extraction backend, the backend's name, its record type and PARSER_VERSION. Each entry holds the
+    extracted text as well as the parsed fields, so a parser change only costs a re-parse rather than another
+    PyPDF2 or OCR pass.
+
+    """
+
+    def __init__(self, filename: str) -> None:
+        self.filename = filename
+        self.connection = sqlite3.connect(filename, timeout=60)
+        # Write-ahead logging lets worker processes read while another one writes
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        # Worker processes open the cache at once, so the table is looked at and upgraded by one at a time
+        self.connection.execute("BEGIN IMMEDIATE")
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(extraction)")]
+        if columns and "backend" not in columns:
+            self.connection.execute("ALTER TABLE extraction RENAME TO extraction_without_backend")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS extraction (
+            content_hash TEXT NOT NULL,
+            record_type INTEGER NOT NULL,
+            backend TEXT NOT NULL,
+            parser_version INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            fields TEXT NOT NULL,
+            last_used REAL NOT NULL,
+            PRIMARY KEY (content_hash, record_type, backend, parser_version))""")
+        if columns and "backend" not in columns:
+            # Entries from before the backend was part of the key were keyed by the pdf's hash, as pypdf2 entries are
+            self.connection.execute("INSERT OR IGNORE INTO extraction SELECT content_hash, record_type, 'pypdf2', "
+                "parser_version, text, fields, last_used FROM extraction_without_backend")
+            self.connection.execute("DROP TABLE extraction_without_backend")
+        self.connection.commit()
+
+    def get(self, content_hash: str, record_type: int, backend: str) -> tuple:
+        """Return (text, fields) for a file, or (None, None) if it isn't cached.
+
+        Fields is None if the text was only cached by an older parser version. For a multi-page pdf
+        fields is a list holding the fields of each note, and text is empty.
+
+        """
+        with profile_stage("cache"):
+            return self._get(content_hash, record_type, backend)
+
+    def _get(self, content_hash: str, record_type: int, backend: str) -> tuple:
+        row = self.connection.execute(
+            "SELECT parser_version, text, fields FROM extraction WHERE content_hash = ? AND record_type = ? "
+            "AND backend = ? ORDER BY parser_version = ? DESC, parser_version DESC LIMIT 1",
+            (content_hash, record_type, backend, PARSER_VERSION)).fetchone()
+        if row is None:
+            return None, None
+        parser_version, text, fields = row
+        if parser_version != PARSER_VERSION:
+            return text, None
+
+        self.connection.execute(
+            "UPDATE extraction SET last_used = ? WHERE content_hash = ? AND record_type = ? AND backend = ? "
+            "AND parser_version = ?", (time.time(), content_hash, record_type, backend, PARSER_VERSION))
+        self.connection.commit()
+        return text, json.loads(fields, object_hook=_decode_field)
+
+    def put(self, content_hash: str, record_type: int, backend: str, text: str, fields: dict) -> None:
+        with profile_stage("cache"):
+            self.connection.execute(
+                "INSERT OR REPLACE INTO extraction VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (content_hash, record_type, backend, PARSER_VERSION, text, json.dumps(fields, default=_encode_field),
+                    time.time()))
+            self.connection.commit()
+
+    def evict(self, max_age_days: float = None, max_entries: int = None) -> int:
+        """Remove stale entries and return the number removed.
+
+        Args:
+            max_age_days: Remove entries that haven't been used for this many days.
+            max_entries: Keep at most this many entries, removing the least recently used first.
+
+        """
+        removed = self.connection.execute(
+            "DELETE FROM extraction WHERE parser_version != ?", (PARSER_VERSION,)).rowcount
+        if max_age_days is not None:
+            removed += self.connection.execute(
+                "DELETE FROM extraction WHERE last_used < ?",
+                (time.time() - max_age_days * 24 * 60 * 60,)).rowcount
+        if max_entries is not None:
+            removed += self.connection.execute(
+                "DELETE FROM extraction WHERE rowid NOT IN "
+                "(SELECT rowid FROM extraction ORDER BY last_used DESC LIMIT ?)",
+                (max_entries,)).rowcount
+        self.connection.commit()
+        return removed
+
+    def clear(self) -> None:
+        self.connection.execute("DELETE FROM extraction")
+        self.connection.commit()
+        self.connection.execute("VACUUM")
+
+    def close(self) -> None:
+        self.connection.close()
+
+# Each worker process opens its own connection to the extraction cache on first use
+_open_caches = {}
+
+def get_extraction_cache(filename: str) -> ExtractionCache:
+    if filename not in _open_caches:
+        _open_caches[filename] = ExtractionCache(filename)
+    return _open_caches[filename]
+
+def close_extraction_cache(filename: str) -> None:
+    if filename in _open_caches:
+        _open_caches.pop(filename).close()
+
+def load_investment_record_file(filename: str, record_type: int, cache_filename: str = None) -> tuple:
+    """Return (records, error, profile samples) for a single pdf file.
+
+    Any failure is caught and returned as an error message rather than raised, so that one bad file
+    doesn't stop the rest of the run. This is a module level function so it can be sent to worker processes.
+    If the run is being profiled, the samples collected while reading the file are returned
+    so they can be sent back from a worker process.
+
+    """
+    records, error = None, None
+    with profile_stage("file", (filename, RECORD_PARSERS[record_type].name)):
+        try:
+            cache = get_extraction_cache(cache_filename) if cache_filename else None
+            records = read_investment_records(filename, record_type, cache)
+        except Exception as e:
+            error = str(e)
+    return records, error, (PROFILER.drain() if PROFILER is not None else None)
+
+def configure_worker(ocr_dpi: int, ocr_workers: int, profile: bool, extraction_backends: dict) -> None:
+    configure_ocr(ocr_dpi, ocr_workers)
+    enable_profiling(profile)
+    configure_extraction_backends(extraction_backends)
+
+def load_investment_records(filenames: list, jobs: int = 1, progress_bar: "ChargingBar" = None,
+        cache_filename: str = None) -> tuple:
+    """Return (records, failures) for a list of (filename, record_type) tuples.
+
+    Records are returned in the same order as filenames regardless of the order in which workers finish,
+    with the notes of a multi-page pdf in page order.
+    Failures is a list of (filename, error message) tuples, also in filenames order.
+
+    Args:
+        filenames: A list of (filename, record_type) tuples, as returned by get_investment_record_filenames.
+        jobs: The number of worker processes to use. 1 reads every file in this process, 0 uses one per CPU core.
+        progress_bar: Optional progress bar, advanced once per file as workers finish them, in whatever order.
+        cache_filename: Optional SQLite file used as an extraction cache, shared by all workers.
+
+    """
+    investment_records = []
+    failures = []
+    # A pool isn't worth starting for a single file
+    jobs = jobs if len(filenames) > 1 else 1
+    for filename, record_type, records, error in iter_investment_record_files(filenames, jobs, None, cache_filename, progress_bar):
+        if records is None:
+            failures.append((filename, error))
         else:
-            with open(self.filename, "rb") as f:
-                pdf_reader = PyPDF2.PdfFileReader(f)
+            investment_records.extend(records)
+    return investment_records, failures
 
-                # Ensure it's a single page
-                if pdf_reader.numPages > 1:
-                    raise Exception("Only single-page pdfs are accepted")
+def iter_investment_record_files(filenames, jobs: int = 1, window: int = None, cache_filename: str = None,
+        progress_bar: "ChargingBar" = None):
+    """Yield (filename, record_type, records, error) for each (filename, record_type) of an iterable, in the same order.
 
-                # Get all the data we want
-                text = pdf_reader.getPage(0).extractText()
+    A file that couldn't be read has records None and an error message. filenames is only taken as far as is needed
+    to keep window files being read, so it can be a generator that is still scanning. Files read by workers ahead of
+    the one being waited on are held until their turn, so memory is bounded by window rather than by the number of files.
 
-        populators = {
-            WH_CONTRACTNOTE: self.populate_WH_ContractNote,
-            VDGR_REINVESTMENT_PLAN_ADVICE: self.populate_VDGR_Reinvestment_Plan_Advice,
-            FAIR_DISTRIBUTION_ADVICE: self.populate_FAIR_Distribution_Advice
-        }
+    Args:
+        filenames: An iterable of (filename, record_type) tuples.
+        jobs: The number of worker processes to use. 1 reads every file in this process, 0 uses one per CPU core.
+        window: The most files being read, or read and waiting their turn, at once. None takes every file at the start.
+            Ignored when reading in this process, which reads one file at a time.
+        cache_filename: Optional SQLite file used as an extraction cache, shared by all workers.
+        progress_bar: Optional progress bar, advanced once per file as soon as it is read. Files read by workers
+            ahead of the one being waited on are counted when they finish, so one slow file doesn't hold the bar back.
+
+    """
+    if jobs == 1:
+        for filename, record_type in filenames:
+            records, error, samples = load_investment_record_file(filename, record_type, cache_filename)
+            if samples:
+                # Drained along with every other sample taken in this process, so they must all be put back
+                PROFILER.merge(samples)
+            if progress_bar:
+                progress_bar.next()
+            yield filename, record_type, records, error
+        return
+
+    with ProcessPoolExecutor(max_workers=(jobs if jobs > 0 else None),
+            initializer=configure_worker, initargs=(OCR_DPI, OCR_WORKERS, PROFILER is not None, RECORD_EXTRACTION_BACKENDS)) as executor:
+
+        # Done callbacks run on the pool's own thread, or on this one if the future is already done
+        progress_lock = threading.Lock()
+
+        def advance_progress_bar(future: Future) -> None:
+            with progress_lock:
+                progress_bar.next()
+
+        def submit(filename: str, record_type: int) -> Future:
+            try:
+                future = executor.submit(load_investment_record_file, filename, record_type, cache_filename)
+            except Exception as e:
+                # Once a worker has died the pool takes no more files (BrokenProcessPool), so the file fails
+                # like those already submitted rather than stopping the run
+                future = Future()
+                future.set_exception(e)
+            if progress_bar:
+                future.add_done_callback(advance_progress_bar)
+            return future
+
+        pending = deque()
+        remaining = iter(filenames)
+        for filename, record_type in islice(remaining, window):
+            pending.append((filename, record_type, submit(filename, record_type)))
+        while pending:
+            filename, record_type, future = pending.popleft()
+            try:
+                records, error, samples = future.result()
+            except Exception as e:
+                # The worker itself died (e.g. BrokenProcessPool), rather than the file failing to parse
+                records, error, samples = None, str(e), None
+            for next_filename, next_record_type in islice(remaining, 1):
+                pending.append((next_filename, next_record_type, submit(next_filename, next_record_type)))
+            if samples:
+                PROFILER.merge(samples)
+            yield filename, record_type, records, error
+
+def print_ocr_report(investment_records: List[InvestmentRecord]) -> None:
+    """Print the time spent on OCR for each record that needed it, slowest first.
+
+    """
+    ocr_records = [record for record in investment_records if record.ocr_method]
+    ocr_records.sort(key=attrgetter("ocr_seconds"), reverse=True)
+    for record in ocr_records:
+        print("{:8.2f}s  {:<10}  {}".format(record.ocr_seconds, record.ocr_method, record.source))
+    print("{:8.2f}s  total OCR time for {} file(s)".format(
+        sum(record.ocr_seconds for record in ocr_records), len(ocr_records)))
+
+def build_filename_classifier():
+    """Return one compiled pattern that recognises the filename of every registered record type.
+
+    Each record type's filename pattern becomes a named group, so match.lastgroup gives the record type
+    with a single fullmatch per file.
+
+    """
+    return re.compile("|".join(
+        "(?P<record_type_" + str(record_type) + ">" + parser.filename_pattern.pattern + ")"
+        for record_type, parser in RECORD_PARSERS.items()))
+
+def classify_filename(classifier, filename: str) -> int:
+    """Return the record type of a filename, or None if it isn't an investment record.
+
+    """
+    match = classifier.fullmatch(filename)
+    if match is None:
+        return None
+    return int(match.lastgroup[len("record_type_"):])
+
+def compile_globs(globs: list):
+    """Return one compiled pattern matching any of a list of globs, or None if there are none.
+
+    """
+    if not globs:
+        return None
+    return re.compile("|".join("(?:" + fnmatch.translate(glob) + ")" for glob in globs), re.IGNORECASE)
 
-        populators.get(self.record_type)(text)
+def scan_directory(dirpath: str, relpath: str, classifier, include, exclude) -> tuple:
+    """List one directory, returning (files, subdirectories).
 
-        # Data type conversions for all record types
-        self.quantity = float(self.quantity.replace(",", ""))
-        self.average_price_per_share = float(self.average_price_per_share.replace("$",""))
-        self.brokerage = float(self.brokerage.replace("$",""))
+    files is a list of (name, record_type, size, mtime) for investment record files, and subdirectories
+    a list of names, both in listing order. Paths relative to the scan root, with / separators,
+    are matched against the include and exclude globs. As with os.walk, symlinks to directories aren't followed,
+    so a symlink loop can't trap the scan and no file is found twice. Raises OSError if dirpath can't be listed.
 
+    """
+    files = []
+    subdirectories = []
+    with os.scandir(dirpath) as entries:
+        for entry in entries:
+            entry_relpath = relpath + entry.name
+            if exclude is not None and exclude.match(entry_relpath):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                subdirectories.append(entry.name)
+                continue
+            record_type = classify_filename(classifier, entry.name)
+            if record_type is None or (include is not None and not include.match(entry_relpath)):
+                continue
+            try:
+                # Symlinks to files are followed, but not those to directories or that are broken
+                if not entry.is_file():
+                    continue
+                stat = entry.stat()
+            except OSError:
+                continue
+            files.append((entry.name, record_type, stat.st_size, stat.st_mtime_ns))
+    return files, subdirectories
 
-def get_investment_record_filenames(path: str) -> list:
-    """Return a list of filenames matching the contract note format (WH_ContractNote_....pdf).
+def get_investment_record_filenames(path: str, include: list = None, exclude: list = None) -> list:
+    """Return a list of (filename, record_type) for files matching a registered record type (e.g. WH_ContractNote_....pdf).
 
     Args:
         path: The path to search. All subdirectories within the path are also searched.
+        include: Optional list of globs. If given, only files whose path relative to path matches one are returned.
+        exclude: Optional list of globs. Files and directories whose relative path matches one are skipped.
 
     """
-    contract_note_filenames = []
-    for dirpath, dirnames, filenames in os.walk(path):
-        for filename in filenames:
-            if re.fullmatch(r"WH_ContractNote_.+\.pdf", filename):
-                record_type = WH_CONTRACTNOTE
-            elif re.fullmatch(r"FAIR_Distribution_Advice_.+\.pdf", filename):
-                record_type = FAIR_DISTRIBUTION_ADVICE
-            elif re.fullmatch(r"VDGR_Reinvestment_Plan_Advice_.+\.pdf", filename):
-                record_type = VDGR_REINVESTMENT_PLAN_ADVICE
-            else:
+    return [(filename, record_type) for filename, record_type, size, mtime in
+        scan_investment_record_files(path, include, exclude)]
+
+def scan_investment_record_files(path: str, include: list = None, exclude: list = None):
+    """Yield (filename, record_type, size, mtime) for files matching a registered record type.
+
+    Directories are walked top-down in the same order as os.walk. See get_investment_record_filenames for arguments.
+
+    """
+    classifier = build_filename_classifier()
+    include = compile_globs(include)
+    exclude = compile_globs(exclude)
+    # Stack of (directory path, path relative to the scan root)
+    stack = [(path, "")]
+    while stack:
+        dirpath, relpath = stack.pop()
+        try:
+            files, subdirectories = scan_directory(dirpath, relpath, classifier, include, exclude)
+        except OSError:
+            # As with os.walk, a directory that can't be listed is skipped
+            continue
+        for name, record_type, size, mtime in files:
+            yield os.path.join(dirpath, name), record_type, size, mtime
+        for name in reversed(subdirectories):
+            stack.append((os.path.join(dirpath, name), relpath + name + "/"))
+
+class ScanManifest():
+    """Remembers the result of the last scan of a path, so the next scan only lists directories that changed.
+
+    For each directory the manifest holds its mtime, its investment record files with their (size, mtime),
+    and its subdirectories. Adding, removing or renaming a file changes its directory's mtime, so a directory
+    whose mtime is unchanged is taken from the manifest without being listed. Only directories are stat'ed.
+    A file rewritten in place doesn't change its directory's mtime and isn't noticed, which is fine for
+    contract notes as they never change once issued.
+
+    """
+
+    VERSION = 1
+
+    def __init__(self, filename: str, path: str, include: list = None, exclude: list = None) -> None:
+        self.filename = filename
+        self.settings = {"version": self.VERSION, "path": os.path.abspath(path),
+            "include": include or [], "exclude": exclude or []}
+        self.directories = {}
+        if os.path.isfile(filename):
+            with open(filename, encoding="utf-8") as f:
+                data = json.load(f)
+            # A manifest of a different path or filters is no use
+            if data.get("settings") == self.settings:
+                self.directories = data["directories"]
+
+    def save(self) -> None:
+        with open(self.filename + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({"settings": self.settings, "directories": self.directories}, f)
+        os.replace(self.filename + ".tmp", self.filename)
+
+    def scan(self, path: str) -> tuple:
+        """Scan path, returning (files, changed, removed) and updating the manifest.
+
+        files is a list of (filename, record_type) in os.walk order, changed the subset of files that are new or
+        whose size or mtime changed since the last scan, and removed a list of filenames no longer present.
+
+        """
+        classifier = build_filename_classifier()
+        include = compile_globs(self.settings["include"])
+        exclude = compile_globs(self.settings["exclude"])
+        old_directories = self.directories
+        new_directories = {}
+        files = []
+        changed = []
+
+        stack = [(path, "")]
+        while stack:
+            dirpath, relpath = stack.pop()
+            try:
+                mtime = os.stat(dirpath).st_mtime_ns
+            except OSError:
                 continue
+            old = old_directories.get(dirpath)
+            if old is not None and old["mtime"] == mtime:
+                new_directories[dirpath] = old
+                for name, record_type, size, file_mtime in old["files"]:
+                    files.append((os.path.join(dirpath, name), record_type))
+            else:
+                try:
+                    dir_files, subdirectories = scan_directory(dirpath, relpath, classifier, include, exclude)
+                except OSError:
+                    # Skipped as os.walk would, and left out of the manifest so it is listed again next time
+                    continue
+                new_directories[dirpath] = {"mtime": mtime, "files": dir_files, "subdirectories": subdirectories}
+                old_files = {} if old is None else {name: (size, file_mtime) for name, record_type, size, file_mtime in old["files"]}
+                for name, record_type, size, file_mtime in dir_files:
+                    files.append((os.path.join(dirpath, name), record_type))
+                    if old_files.get(name) != (size, file_mtime):
+                        changed.append((os.path.join(dirpath, name), record_type))
+            for name in reversed(new_directories[dirpath]["subdirectories"]):
+                stack.append((os.path.join(dirpath, name), relpath + name + "/"))
+
+        current = {filename for filename, record_type in files}
+        removed = [os.path.join(dirpath, entry[0]) for dirpath, directory in old_directories.items()
+            for entry in directory["files"] if os.path.join(dirpath, entry[0]) not in current]
+        self.directories = new_directories
+        return files, changed, removed
+
+# What calculated cells (cost bases, gains and financial year totals) hold:
+#   formulas: Excel formulas, as the spreadsheet has always had
+#   values: values calculated here, so readers that don't calculate formulas (openpyxl, pandas) see them
+#   both: values, with each formula as text in extra columns after Filename
+CELL_VALUES = ("formulas", "values", "both")
+CALCULATED_COLUMNS = ["Cost base", "Capital gain <= 1 year", "Capital gain > 1 year", "Net capital gain"]
+# Columns totalled for each financial year, on the code sheets and the Summary sheet
+FIN_YEAR_TOTAL_COLUMNS = ["Brokerage", "Capital gain <= 1 year", "Capital gain > 1 year"]
+
+@lru_cache(maxsize=None)
+def get_fiscal_date_time():
+    import fiscalyear
+    # In Australia, the financial year begins on 1 July
+    # Fiscal year is represented by the year of its end date
+    fiscalyear.setup_fiscal_calendar('previous', 7, 1)
+    return fiscalyear.FiscalDateTime
+
+@lru_cache(maxsize=None)
+def fiscal_year_of(date_ordinal: int) -> int:
+    # Records often share dates (and every record is checked against the previous date),
+    # so each distinct date is only converted once
+    date = datetime.fromordinal(date_ordinal)
+    return get_fiscal_date_time()(date.year, date.month, date.day).fiscal_year
+
+class RecordTable():
+    """The fields of many records that code sheets are built from, held column by column.
+
+    Each record is a row number into the columns, in the order the records were added. Codes and
+    trade types are interned and stored as ids, dates as day ordinals (every record type is dated
+    to the day), and quantities, prices and brokerage as arrays of doubles. This takes a fraction of the
+    memory of the records themselves, and sorting, grouping and lot matching only touch the columns they need.
+
+    After index() is called, by_code holds the row numbers of each code in the order they appear on its sheet:
+    by date, then trade type, then the order they were added. available and sheet_rows are working columns
+    filled in as code sheets are built, holding the unsold quantity of each lot and the sheet row of each record.
+
+    """
 
-            contract_note_filenames.append((os.path.join(dirpath, filename), record_type))
-                
-    return contract_note_filenames
+    def __init__(self) -> None:
+        self.code_names = []
+        self.code_ids = {}
+        self.type_names = []
+        self.type_ids = {}
+        self.type_is_sale = []
+        self.codes = array("l")
+        self.trade_types = array("l")
+        self.dates = array("l")
+        self.quantities = array("d")
+        self.prices = array("d")
+        self.brokerages = array("d")
+        self.sources = []
+        self.available = array("d")
+        self.sheet_rows = array("l")
+        self.by_code = {}
+
+    @classmethod
+    def from_records(cls, records: list) -> "RecordTable":
+        table = cls()
+        for record in records:
+            table.append(record)
+        table.index()
+        return table
 
-def initialise_for_new_code(workbook: Workbook, code: str, records: list) -> Worksheet:
-    # We can work on the workbook as well as the list of records in place
-    sheet = workbook.create_sheet(code)
-    for name, column_idx in COLUMNS.items(): 
-        sheet.cell(1, column_idx).value = name
+    def __len__(self) -> int:
+        return len(self.sources)
 
-    records.sort(key=attrgetter("trade_date", "trade_type"))
-    for record in records:
-        if(record.trade_type.lower() in "buy", "mfund application", "drp"):
-            record.available_quantity = record.quantity
+    def append(self, record: InvestmentRecord) -> int:
+        """Add a record's fields as a new row, returning its row number.
 
-    return sheet
+        """
+        if record.code not in self.code_ids:
+            self.code_ids[record.code] = len(self.code_names)
+            self.code_names.append(record.code)
+        if record.trade_type not in self.type_ids:
+            self.type_ids[record.trade_type] = len(self.type_names)
+            self.type_names.append(record.trade_type)
+            self.type_is_sale.append(record.trade_type.lower() in SALE_TRADE_TYPES)
+        self.codes.append(self.code_ids[record.code])
+        self.trade_types.append(self.type_ids[record.trade_type])
+        self.dates.append(record.trade_date.toordinal())
+        self.quantities.append(record.quantity)
+        self.prices.append(record.average_price_per_share)
+        self.brokerages.append(record.brokerage)
+        self.sources.append(record.source)
+        self.available.append(0.0)
+        self.sheet_rows.append(0)
+        return len(self.sources) - 1
+
+    def index(self) -> None:
+        """Group the rows by code, and sort each code's rows into sheet order.
 
-def fiscal_year_check(sheet: Worksheet, fisc_year_start_idx: int, row_idx: int, prev_date: datetime, new_date: datetime, summaries: list, force_ytd_summary: bool) -> int:
-    new_fiscal_year = FiscalDateTime(new_date.year, new_date.month, new_date.day).fiscal_year
-    prev_fiscal_year = FiscalDateTime(prev_date.year, prev_date.month, prev_date.day).fiscal_year
+        """
+        rows_by_code = [[] for _ in self.code_names]
+        for row, code_id in enumerate(self.codes):
+            rows_by_code[code_id].append(row)
+        # Sorting by a rank avoids looking up each row's trade type name
+        type_rank = [0] * len(self.type_names)
+        for rank, type_id in enumerate(sorted(range(len(self.type_names)), key=self.type_names.__getitem__)):
+            type_rank[type_id] = rank
+        dates, trade_types = self.dates, self.trade_types
+        self.by_code = {}
+        for code_id in sorted(range(len(self.code_names)), key=lambda code_id: rows_by_code[code_id][0]):
+            rows = rows_by_code[code_id]
+            rows.sort(key=lambda row: (dates[row], type_rank[trade_types[row]]))
+            self.by_code[self.code_names[code_id]] = array("l", rows)
+
+    def code(self, row: int) -> str:
+        return self.code_names[self.codes[row]]
+
+    def trade_type(self, row: int) -> str:
+        return self.type_names[self.trade_types[row]]
+
+    def trade_date(self, row: int) -> datetime:
+        return datetime.fromordinal(self.dates[row])
+
+    def is_sale(self, row: int) -> bool:
+        return self.type_is_sale[self.trade_types[row]]
+
+class CodeLedger():
+    """The computed rows of a single code sheet, held as plain lists until they are written out.
+
+    Rows and columns are numbered from 1 as on the sheet, and row 1 holds the column headings.
+    Building every row first means earlier rows (such as the History of a bought lot) can be patched
+    cheaply, and the finished sheet can then be streamed to a write-only workbook in one pass.
+
+    """
+
+    def __init__(self, code: str, cell_values: str = "formulas") -> None:
+        self.code = code
+        self.cell_values = cell_values
+        headings = list(COLUMNS)
+        if cell_values == "both":
+            headings += [column_name + " formula" for column_name in CALCULATED_COLUMNS]
+        self.width = len(headings)
+        self.rows = [headings]
+        # Named style applied to every cell in a row, keyed by row number
+        self.row_styles = {1: "Accent1"}
+        # Running totals for the current financial year, reset by fiscal_year_check
+        self.fin_year_totals = dict.fromkeys(FIN_YEAR_TOTAL_COLUMNS, 0.0)
+
+    def set(self, row_idx: int, column_name: str, value) -> None:
+        while len(self.rows) < row_idx:
+            self.rows.append([None] * self.width)
+        self.rows[row_idx - 1][COLUMNS[column_name] - 1] = value
+
+    def get(self, row_idx: int, column_name: str):
+        if row_idx > len(self.rows):
+            return None
+        return self.rows[row_idx - 1][COLUMNS[column_name] - 1]
+
+    def set_calculated(self, row_idx: int, column_name: str, formula: str, value: float) -> None:
+        """Set a calculated cell to its formula, its value, or (in "both" mode) its value with the formula alongside.
+
+        """
+        if self.cell_values == "formulas":
+            self.set(row_idx, column_name, formula)
+            return
+        self.set(row_idx, column_name, value)
+        if self.cell_values == "both":
+            # Written without the leading = so it is kept as text rather than calculated
+            self.rows[row_idx - 1][len(COLUMNS) + CALCULATED_COLUMNS.index(column_name)] = formula[1:]
+
+    def set_row_style(self, row_idx: int, style: str) -> None:
+        while len(self.rows) < row_idx:
+            self.rows.append([None] * self.width)
+        self.row_styles[row_idx] = style
+
+    def with_cell_values(self, cell_values: str) -> "CodeLedger":
+        """Return this ledger with calculated cells holding cell_values, the same as if it had been computed that way.
+
+        A ledger can only be converted from "both", which holds the values and the formulas, or to its own cell values.
+
+        """
+        if cell_values == self.cell_values:
+            return self
+        if self.cell_values != "both":
+            raise ValueError("Can't convert a ledger of " + self.cell_values + " to " + cell_values)
+        ledger = CodeLedger(self.code, cell_values)
+        ledger.row_styles = self.row_styles
+        num_columns = len(COLUMNS)
+        for row in islice(self.rows, 1, None):
+            new_row = row[:num_columns]
+            if cell_values == "formulas":
+                for formula_idx, column_name in enumerate(CALCULATED_COLUMNS):
+                    formula = row[num_columns + formula_idx]
+                    if formula is not None:
+                        new_row[COLUMNS[column_name] - 1] = "=" + formula
+            ledger.rows.append(new_row)
+        return ledger
+
+def fiscal_year_check(ledger: CodeLedger, fisc_year_start_idx: int, row_idx: int, prev_date: int, new_date: int, summaries: list, force_ytd_summary: bool) -> int:
+    new_fiscal_year = fiscal_year_of(new_date)
+    prev_fiscal_year = fiscal_year_of(prev_date)
 
     if (new_fiscal_year > prev_fiscal_year) or force_ytd_summary:
 
-        sheet.cell(row_idx, COLUMNS["Date"]).value = "END OF FINANCIAL YEAR " + \
-            str(prev_fiscal_year-1) + "-" + str(prev_fiscal_year)
+        ledger.set(row_idx, "Date", "END OF FINANCIAL YEAR " + \
+            str(prev_fiscal_year-1) + "-" + str(prev_fiscal_year))
 
+        totals = ledger.fin_year_totals
         for column_name in ["Capital gain <= 1 year", "Capital gain > 1 year"]:
-            col_letter = cell.get_column_letter(COLUMNS[column_name])
+            col_letter = get_column_letter(COLUMNS[column_name])
             formula = "=sum(" + col_letter + str(fisc_year_start_idx) + ":" \
                 + col_letter + str(row_idx - 1) + ")"
-            sheet.cell(row_idx, COLUMNS[column_name]).value = formula
+            ledger.set_calculated(row_idx, column_name, formula, totals[column_name])
 
-        net_capital_gain_formula = "=" + cell.get_column_letter(COLUMNS["Capital gain <= 1 year"]) + str(row_idx) \
-            + "+(" + cell.get_column_letter(COLUMNS["Capital gain > 1 year"]) + str(row_idx) +"/2)"
-        sheet.cell(row_idx, COLUMNS["Net capital gain"]).value = net_capital_gain_formula
+        net_capital_gain_formula = "=" + get_column_letter(COLUMNS["Capital gain <= 1 year"]) + str(row_idx) \
+            + "+(" + get_column_letter(COLUMNS["Capital gain > 1 year"]) + str(row_idx) +"/2)"
+        net_capital_gain = totals["Capital gain <= 1 year"] + (totals["Capital gain > 1 year"] / 2)
+        ledger.set_calculated(row_idx, "Net capital gain", net_capital_gain_formula, net_capital_gain)
 
-        for column_name in COLUMNS:
-            sheet.cell(row_idx, COLUMNS[column_name]).style = "Accent1"
+        ledger.set_row_style(row_idx, "Accent1")
 
-        # summaries.append({
-        #     "fiscal_year_end": prev_fiscal_year, 
-        #     "brokerage_ref": col_letter + str(row_idx),
-        #     "capital_gain_ref": cap_gain_letter + str(row_idx),
-        #     "is_ytd_only": force_ytd_summary
-        #     })
+        summary = {"fiscal_year_end": prev_fiscal_year, "is_ytd_only": force_ytd_summary}
+        summary.update(totals)
+        summary["Net capital gain"] = net_capital_gain
+        summaries.append(summary)
+        ledger.fin_year_totals = dict.fromkeys(FIN_YEAR_TOTAL_COLUMNS, 0.0)
 
         return row_idx + 1, row_idx + 1
     return row_idx, fisc_year_start_idx
 
-def add_new_record_row(sheet: Worksheet, row_idx: int, record: InvestmentRecord) -> int:
-    # Spreadsheet row is stored in the record object for later reference
-    record.row_idx = row_idx
-    sheet.cell(row_idx, COLUMNS["Date"]).value = record.trade_date
-    sheet.cell(row_idx, COLUMNS["Code"]).value = record.code
-    sheet.cell(row_idx, COLUMNS["Quantity"]).value = record.quantity
-    sheet.cell(row_idx, COLUMNS["Average price"]).value = record.average_price_per_share
-    sheet.cell(row_idx, COLUMNS["Transaction type"]).value = record.trade_type
-    sheet.cell(row_idx, COLUMNS["Brokerage"]).value = record.brokerage
-    sheet.cell(row_idx, COLUMNS["Filename"]).value = record.filename
+def add_new_record_row(ledger: CodeLedger, row_idx: int, table: RecordTable, row: int) -> int:
+    # Spreadsheet row is stored in the table for later reference
+    table.sheet_rows[row] = row_idx
+    ledger.set(row_idx, "Date", table.trade_date(row))
+    ledger.set(row_idx, "Code", table.code(row))
+    ledger.set(row_idx, "Quantity", table.quantities[row])
+    ledger.set(row_idx, "Average price", table.prices[row])
+    ledger.set(row_idx, "Transaction type", table.trade_type(row))
+    ledger.set(row_idx, "Brokerage", table.brokerages[row])
+    ledger.set(row_idx, "Filename", table.sources[row])
+    ledger.fin_year_totals["Brokerage"] += table.brokerages[row]
 
 def find_records_to_sell_fifo(records: list, sale_record: InvestmentRecord) -> list:
     # We assume records is already sorted
+    # This rescans records from the start for every sale. Sheets are built with LotMatcher instead,
+    # and this is kept as the reference it is checked against in benchmark.py
     quantity_to_sell = sale_record.quantity
     recs_and_quants_sold = []
     for record in records:
@@ -269,156 +1446,1435 @@ def find_records_to_sell_fifo(records: list, sale_record: InvestmentRecord) -> l
             record.available_quantity = 0
     return recs_and_quants_sold
 
-def add_sale_data(sheet: Worksheet, sale_record: InvestmentRecord, recs_and_quants_to_sell: list):
+SALE_TRADE_TYPES = ("sell", "mfund redemption")
+
+class LotMatcher():
+    """Matches sales against the open lots of a single code.
+
+    Rows of a RecordTable must be given in date order, as they are laid out on a code sheet. Every record that
+    isn't a sale opens a lot, and each sale consumes open lots according to the selection policy:
+        fifo: oldest lot first, as find_records_to_sell_fifo does
+        lifo: newest lot first
+        highest-cost: the lot with the highest cost per unit (including brokerage) first
+
+    Lots are removed from the queue once used up, so each lot is visited at most once more than the number
+    of sales that draw from it and total matching cost is linear (n log n for highest-cost) in the number
+    of records. The unsold quantity of each lot is kept in the table's available column.
+
+    """
+
+    POLICIES = ("fifo", "lifo", "highest-cost")
+
+    def __init__(self, table: RecordTable, policy: str = "fifo") -> None:
+        if policy not in self.POLICIES:
+            raise ValueError("Unknown lot selection policy " + policy)
+        self.table = table
+        self.policy = policy
+        # fifo uses the left end of a deque of rows as its cursor, lifo the right end.
+        # highest-cost uses a heap of (-cost per unit, insertion order, row).
+        self.open_lots = [] if policy == "highest-cost" else deque()
+        self.lots_added = 0
+
+    def add_lot(self, row: int) -> None:
+        quantity = self.table.quantities[row]
+        self.table.available[row] = quantity
+        if self.policy == "highest-cost":
+            cost_per_unit = self.table.prices[row] + (self.table.brokerages[row] / quantity if quantity else 0)
+            heapq.heappush(self.open_lots, (-cost_per_unit, self.lots_added, row))
+        else:
+            self.open_lots.append(row)
+        self.lots_added += 1
+
+    def _next_lot(self) -> int:
+        if self.policy == "highest-cost":
+            return self.open_lots[0][2]
+        if self.policy == "lifo":
+            return self.open_lots[-1]
+        return self.open_lots[0]
+
+    def _remove_next_lot(self) -> None:
+        if self.policy == "highest-cost":
+            heapq.heappop(self.open_lots)
+        elif self.policy == "lifo":
+            self.open_lots.pop()
+        else:
+            self.open_lots.popleft()
+
+    def sell(self, sale_row: int) -> list:
+        """Return a list of (row, quantity) tuples for the lots used by a sale.
+
+        Raises an exception if there aren't enough open lots to cover the sale. As with find_records_to_sell_fifo,
+        the open lots are still used up in that case. A sale of no quantity raises an exception without using any lots,
+        as it has no cost base to share its brokerage with.
+
+        """
+        available = self.table.available
+        quantity_to_sell = self.table.quantities[sale_row]
+        if not quantity_to_sell > 0:
+            raise Exception("No quantity sold in sale record " + self.table.sources[sale_row])
+        rows_and_quants_sold = []
+        while True:
+            if not self.open_lots:
+                raise Exception("Insufficient buy records found for sale record " + self.table.sources[sale_row])
+            row = self._next_lot()
+            if available[row] >= quantity_to_sell:
+                rows_and_quants_sold.append((row, quantity_to_sell))
+                available[row] -= quantity_to_sell
+                if available[row] == 0:
+                    self._remove_next_lot()
+                break
+            elif available[row] > 0:
+                rows_and_quants_sold.append((row, available[row]))
+                quantity_to_sell -= available[row]
+                available[row] = 0
+            self._remove_next_lot()
+        return rows_and_quants_sold
+
+    def add_record(self, row: int) -> list:
+        """Add the next row in date order, returning the (row, quantity) tuples used if it is a sale.
+
+        """
+        if self.table.is_sale(row):
+            return self.sell(row)
+        self.add_lot(row)
+        return []
+
+def sale_part_gain(table: RecordTable, sale_row: int, lot_row: int, quantity: float) -> tuple:
+    """Return (cost base, capital gain, capital gain column) for the part of a sale matched against one lot.
+
+    The cost base includes the share of both the lot's and the sale's brokerage. The gain of a lot held
+    for more than a year goes in the "Capital gain > 1 year" column.
+
+    """
+    cost_base = quantity * table.prices[lot_row] + (table.brokerages[lot_row] * quantity / table.quantities[lot_row]) \
+        + (table.brokerages[sale_row] * quantity / table.quantities[sale_row])
+    capital_gain = (quantity * table.prices[sale_row]) - cost_base
+    if table.dates[sale_row] > table.dates[lot_row] + 365:
+        return cost_base, capital_gain, "Capital gain > 1 year"
+    return cost_base, capital_gain, "Capital gain <= 1 year"
+
+def add_sale_data(ledger: CodeLedger, table: RecordTable, sale_row: int, rows_and_quants_to_sell: list):
     """Returns the number of rows added for subquantities.
     
     """
-    net_capital_gain_formula = "=(" + str(sale_record.quantity) + "*" \
-    + cell.get_column_letter(COLUMNS["Average price"]) \
-    + str(sale_record.row_idx) + ")"
+    sale_row_idx = table.sheet_rows[sale_row]
+    sale_quantity = table.quantities[sale_row]
+    sale_date_text = table.trade_date(sale_row).strftime("%d/%m/%Y. ")
+    net_capital_gain_formula = "=(" + str(sale_quantity) + "*" \
+    + get_column_letter(COLUMNS["Average price"]) \
+    + str(sale_row_idx) + ")"
 
-    num_recs_and_quants = len(recs_and_quants_to_sell)
-    using_subquantities = True if num_recs_and_quants > 1 else False
-    current_row_idx = sale_record.row_idx + 1 if using_subquantities else sale_record.row_idx
-    quantity_column_to_use = COLUMNS["Subquantity"] if using_subquantities else COLUMNS["Quantity"]
+    num_rows_and_quants = len(rows_and_quants_to_sell)
+    using_subquantities = True if num_rows_and_quants > 1 else False
+    current_row_idx = sale_row_idx + 1 if using_subquantities else sale_row_idx
+    quantity_column_to_use = "Subquantity" if using_subquantities else "Quantity"
 
-    for rec,quant in recs_and_quants_to_sell:
+    for row,quant in rows_and_quants_to_sell:
+        lot_row_idx = table.sheet_rows[row]
 
         if using_subquantities:
-            sheet.cell(current_row_idx, quantity_column_to_use).value = quant
+            ledger.set(current_row_idx, quantity_column_to_use, quant)
         # Else we assume the Quantity of the investment record was written earlier
 
-        cost_base_formula = "=" + cell.get_column_letter(quantity_column_to_use) + str(current_row_idx) \
-            + "*" + cell.get_column_letter(COLUMNS["Average price"]) + str(rec.row_idx) \
-            + "+(" + cell.get_column_letter(COLUMNS["Brokerage"]) + str(rec.row_idx) \
-            + "*" + cell.get_column_letter(quantity_column_to_use) + str(current_row_idx) \
-            + "/" + cell.get_column_letter(COLUMNS["Quantity"]) + str(rec.row_idx) + ")" \
-            + "+(" + cell.get_column_letter(COLUMNS["Brokerage"]) + str(sale_record.row_idx) \
-            + "*" + cell.get_column_letter(quantity_column_to_use) + str(current_row_idx) \
-            + "/" + cell.get_column_letter(COLUMNS["Quantity"]) + str(sale_record.row_idx) + ")"
-        sheet.cell(current_row_idx, COLUMNS["Cost base"]).value = cost_base_formula
-
-        capital_gain_formula = "=(" + cell.get_column_letter(quantity_column_to_use) + str(current_row_idx) \
-            + "*" + cell.get_column_letter(COLUMNS["Average price"]) + str(sale_record.row_idx) \
-            + ")-" + cell.get_column_letter(COLUMNS["Cost base"]) + str(current_row_idx) 
-        if sale_record.trade_date > rec.trade_date + timedelta(days=365):
-            capital_gain_column_to_use = COLUMNS["Capital gain > 1 year"]
-        else:
-            capital_gain_column_to_use = COLUMNS["Capital gain <= 1 year"]
-        sheet.cell(current_row_idx, capital_gain_column_to_use).value = capital_gain_formula
-
-        history = sheet.cell(rec.row_idx, COLUMNS["History"]).value
-        new_history = "Sold " + str(quant) + " on " + sale_record.trade_date.strftime("%d/%m/%Y. ")
-        sheet.cell(rec.row_idx, COLUMNS["History"]).value = (history + new_history if history else new_history)
+        cost_base_formula = "=" + get_column_letter(COLUMNS[quantity_column_to_use]) + str(current_row_idx) \
+            + "*" + get_column_letter(COLUMNS["Average price"]) + str(lot_row_idx) \
+            + "+(" + get_column_letter(COLUMNS["Brokerage"]) + str(lot_row_idx) \
+            + "*" + get_column_letter(COLUMNS[quantity_column_to_use]) + str(current_row_idx) \
+            + "/" + get_column_letter(COLUMNS["Quantity"]) + str(lot_row_idx) + ")" \
+            + "+(" + get_column_letter(COLUMNS["Brokerage"]) + str(sale_row_idx) \
+            + "*" + get_column_letter(COLUMNS[quantity_column_to_use]) + str(current_row_idx) \
+            + "/" + get_column_letter(COLUMNS["Quantity"]) + str(sale_row_idx) + ")"
+        cost_base, capital_gain, capital_gain_column_to_use = sale_part_gain(table, sale_row, row, quant)
+        ledger.set_calculated(current_row_idx, "Cost base", cost_base_formula, cost_base)
+
+        capital_gain_formula = "=(" + get_column_letter(COLUMNS[quantity_column_to_use]) + str(current_row_idx) \
+            + "*" + get_column_letter(COLUMNS["Average price"]) + str(sale_row_idx) \
+            + ")-" + get_column_letter(COLUMNS["Cost base"]) + str(current_row_idx) 
+        ledger.set_calculated(current_row_idx, capital_gain_column_to_use, capital_gain_formula, capital_gain)
+        ledger.fin_year_totals[capital_gain_column_to_use] += capital_gain
+
+        history = ledger.get(lot_row_idx, "History")
+        new_history = "Sold " + str(quant) + " on " + sale_date_text
+        ledger.set(lot_row_idx, "History", (history + new_history if history else new_history))
 
         current_row_idx += 1
 
-    return num_recs_and_quants if using_subquantities else 0
+    return num_rows_and_quants if using_subquantities else 0
 
-def format_code_sheet(sheet: Worksheet):
-    for column_name in COLUMNS:
-        sheet.cell(1, COLUMNS[column_name]).style = "Accent1"
+def format_code_sheet(sheet: "Worksheet"):
+    # Heading and summary row styles are applied from the ledger as rows are written
 
     for column_name in ["Average price", "Brokerage", "Cost base", "Capital gain <= 1 year", "Capital gain > 1 year"]: 
-        for this_cell in sheet[cell.get_column_letter(COLUMNS[column_name])]:
-            pass # TODO: Set currency formatting here
+        pass # TODO: Set currency formatting here
     
     # openpyxl has trouble setting column width automatically, so we'll do it manually
+    # (for a write-only sheet this must happen before any rows are written)
     for col_name, col_width in FORMAT.items():
-        sheet.column_dimensions[cell.get_column_letter(COLUMNS[col_name])].width = col_width
-    
+        sheet.column_dimensions[get_column_letter(COLUMNS[col_name])].width = col_width
 
-def add_summary_sheet(workbook: Workbook, all_fin_year_summaries: list):
-    # Use the default sheet created with the workbook
-    sheet = workbook["Sheet"]
-    sheet.title = "Summary"
-    
-    # Expect a list of (string,[dict])
-    #for code, summaries in all_fin_year_summaries:
+def write_code_sheet(workbook: "Workbook", ledger: CodeLedger, index: int = None) -> "Worksheet":
+    """Add a sheet to a workbook and write a computed ledger to it.
 
+    Works for both normal and write-only workbooks. Cells of a write-only workbook can't be revisited,
+    so each row is written once, in order, with its style attached.
 
-def construct_investment_record_workbook(investment_records: List[InvestmentRecord]) -> Workbook:
-    workbook = Workbook()
+    Args:
+        workbook: The workbook to add the sheet to.
+        ledger: The computed rows for the sheet. The ledger's code is used as the sheet title.
+        index: Optional position for the new sheet. By default it is added after the existing sheets.
+            Not supported for write-only workbooks.
 
+    """
+    sheet = workbook.create_sheet(ledger.code) if index is None else workbook.create_sheet(ledger.code, index)
+    format_code_sheet(sheet)
+    for row_idx, row in enumerate(ledger.rows, start=1):
+        append_row(workbook, sheet, row_idx, row, ledger.row_styles.get(row_idx))
+    return sheet
+
+def append_row(workbook: "Workbook", sheet: "Worksheet", row_idx: int, row: list, style: str = None) -> None:
+    """Append a row to a sheet, applying a named style to each of its cells if one is given.
+
+    Args:
+        workbook: The workbook holding the sheet.
+        sheet: The sheet to append to.
+        row_idx: The number the appended row will have. Only used to style a normal sheet's cells.
+        row: The cell values.
+        style: Optional named style.
+
+    """
+    if style is None:
+        sheet.append(row)
+    elif workbook.write_only:
+        from openpyxl.cell import WriteOnlyCell
+        styled_row = []
+        for value in row:
+            styled_cell = WriteOnlyCell(sheet, value)
+            styled_cell.style = style
+            styled_row.append(styled_cell)
+        sheet.append(styled_row)
+    else:
+        sheet.append(row)
+        for column_idx in range(1, len(row) + 1):
+            sheet.cell(row_idx, column_idx).style = style
+
+SUMMARY_SHEET = "Summary"
+SUMMARY_COLUMNS = ["Code", "Financial year"] + FIN_YEAR_TOTAL_COLUMNS + ["Net capital gain"]
+
+def financial_year_label(fiscal_year_end: int) -> str:
+    return str(fiscal_year_end - 1) + "-" + str(fiscal_year_end)
+
+def add_summary_sheet(workbook: "Workbook", all_fin_year_summaries: list):
+    """Write the Summary sheet: each code's totals for each financial year, then the totals of every code.
+
+    Any existing Summary sheet is replaced, and the sheet is kept first.
+
+    Args:
+        workbook: The workbook to write the sheet to.
+        all_fin_year_summaries: A list of (code, [summary dict]), as returned by compute_code_ledger.
+
+    """
+    # Write-only workbooks are created with an empty Summary sheet, so it is first.
+    # Other workbooks have a default sheet, or a Summary sheet from an earlier run.
+    if workbook.write_only:
+        sheet = workbook[SUMMARY_SHEET]
+    else:
+        for title in (SUMMARY_SHEET, "Sheet"):
+            if title in workbook.sheetnames:
+                workbook.remove(workbook[title])
+        sheet = workbook.create_sheet(SUMMARY_SHEET, 0)
+
+    for col_name in SUMMARY_COLUMNS:
+        sheet.column_dimensions[get_column_letter(SUMMARY_COLUMNS.index(col_name) + 1)].width = \
+            FORMAT.get(col_name, 15)
+    append_row(workbook, sheet, 1, SUMMARY_COLUMNS, "Accent1")
+
+    totals_by_year = defaultdict(lambda: dict.fromkeys(SUMMARY_COLUMNS[2:], 0.0))
+    row_idx = 2
+    for code, summaries in all_fin_year_summaries:
+        for summary in summaries:
+            fiscal_year_end = summary["fiscal_year_end"]
+            append_row(workbook, sheet, row_idx, [code, financial_year_label(fiscal_year_end)]
+                + [summary[column_name] for column_name in SUMMARY_COLUMNS[2:]])
+            for column_name in SUMMARY_COLUMNS[2:]:
+                totals_by_year[fiscal_year_end][column_name] += summary[column_name]
+            row_idx += 1
+
+    for fiscal_year_end in sorted(totals_by_year):
+        totals = totals_by_year[fiscal_year_end]
+        append_row(workbook, sheet, row_idx, ["Total", financial_year_label(fiscal_year_end)]
+            + [totals[column_name] for column_name in SUMMARY_COLUMNS[2:]], "Accent1")
+        row_idx += 1
+
+def normalise_codes(investment_records: List[InvestmentRecord]) -> None:
     # Normalise codes to just the ticker, removing any .ASX component.
     # This assumes everything we are trading is on the ASX. If we want to include other exchanges,
     # we will need to include the .ASX.
     for record in investment_records:
         record.code = re.split(r"\.", record.code)[0]
 
-    investment_records_by_code = defaultdict(list)
+class CodeNotGroupedError(Exception):
+    pass
+
+def iter_code_groups(investment_records):
+    """Yield (code, records) for each code of an iterable of records, as soon as the records of the next code begin.
+
+    Each code's records must be together in the iterable, as they are when a code's files are found together
+    (e.g. a directory per code), so that a code's records are known to be complete when another code's begin.
+    Raises CodeNotGroupedError if a code's records turn up again after they were yielded.
+
+    """
+    done_codes = set()
+    code = None
+    code_records = []
     for record in investment_records:
-        investment_records_by_code[record.code].append(record)
+        if record.code != code:
+            if code_records:
+                yield code, code_records
+                done_codes.add(code)
+            if record.code in done_codes:
+                raise CodeNotGroupedError("The records of " + record.code + " aren't together: "
+                    + record.source + " was found after those of another code")
+            code = record.code
+            code_records = []
+        code_records.append(record)
+    if code_records:
+        yield code, code_records
+
+def compute_code_ledger(table: RecordTable, code: str, lot_policy: str = "fifo", cell_values: str = "formulas") -> tuple:
+    """Compute every row of a single code's sheet, returning (ledger, financial year summaries).
+
+    Cost bases, gains and financial year totals are always calculated, whatever cell_values is,
+    as the summaries are made from them.
+
+    Args:
+        table: An indexed table holding the records of this code, and possibly others.
+        code: The code, which is also used as the sheet title.
+        lot_policy: How sales are matched against earlier lots. One of LotMatcher.POLICIES.
+        cell_values: What calculated cells hold. One of CELL_VALUES.
+
+    """
+    rows = table.by_code[code]
+    ledger = CodeLedger(code, cell_values)
+    lot_matcher = LotMatcher(table, lot_policy)
+    current_date = table.dates[rows[0]]
+    code_fin_year_summaries = []
+    # Row 1 used for heading
+    row_idx = 2
+    fisc_year_start_idx = 2
+
+    for row in rows:
+        row_idx, fisc_year_start_idx = fiscal_year_check(ledger, fisc_year_start_idx, row_idx, current_date, table.dates[row], code_fin_year_summaries, False)
+        current_date = table.dates[row]
+        add_new_record_row(ledger, row_idx, table, row)
+        if table.trade_type(row).lower() in ("buy", "drp"):
+            cost_base_formula = "=" \
+                + get_column_letter(COLUMNS["Quantity"]) \
+                + str(row_idx) + "*" \
+                + get_column_letter(COLUMNS["Average price"]) \
+                + str(row_idx) + "+" \
+                + get_column_letter(COLUMNS["Brokerage"]) \
+                + str(row_idx)                         
+            cost_base = table.quantities[row] * table.prices[row] + table.brokerages[row]
+            ledger.set_calculated(row_idx, "Cost base", cost_base_formula, cost_base)
+        if not table.is_sale(row):
+            lot_matcher.add_lot(row)
+        else:
+            try:
+                with profile_stage("lot matching"):
+                    rows_and_quants_sold = lot_matcher.sell(row)
+            except Exception as e:
+                ledger.set(row_idx, "History", str(e))
+            else:
+                row_idx += add_sale_data(ledger, table, row, rows_and_quants_sold)
+        row_idx += 1
+
+    fiscal_year_check(ledger, fisc_year_start_idx, row_idx, current_date, current_date, code_fin_year_summaries, True)
+
+    return ledger, code_fin_year_summaries
+
+# The table a ledger worker computes code ledgers from, sent once to each worker rather than with every code
+LEDGER_TABLE = None
+
+def configure_ledger_worker(table: RecordTable, profile: bool) -> None:
+    global LEDGER_TABLE
+    LEDGER_TABLE = table
+    enable_profiling(profile)
+
+def compute_worker_code_ledger(code: str, lot_policy: str, cell_values: str) -> tuple:
+    # Lot matching works on the worker's own copy of the table's available quantities and sheet rows,
+    # which is fine as nothing reads them once the ledger is computed.
+    with profile_stage("code ledger", code):
+        ledger, code_fin_year_summaries = compute_code_ledger(LEDGER_TABLE, code, lot_policy, cell_values)
+    return ledger, code_fin_year_summaries, (PROFILER.drain() if PROFILER is not None else None)
+
+def compute_code_ledgers(table: RecordTable, codes: list, lot_policy: str = "fifo", cell_values: str = "formulas",
+        jobs: int = 1):
+    """Yield (ledger, financial year summaries) for each of codes, in the order given.
+
+    Codes are independent of each other, so with more than one job their ledgers are computed by worker
+    processes while the caller writes the ones already yielded. Ledgers are yielded in codes order whichever
+    worker finishes first, and only a few ahead of the caller are held at once, so the result is the same
+    as computing them one after another.
+
+    Args:
+        table: An indexed table holding the records of every code.
+        codes: The codes to compute, each of which must be in table.by_code.
+        lot_policy: How sales are matched against earlier lots. One of LotMatcher.POLICIES.
+        cell_values: What calculated cells hold. One of CELL_VALUES.
+        jobs: The number of worker processes to use. 1 computes every ledger in this process, 0 uses one per CPU core.
+
+    """
+    if jobs == 1 or len(codes) <= 1:
+        for code in codes:
+            with profile_stage("code ledger", code):
+                ledger, code_fin_year_summaries = compute_code_ledger(table, code, lot_policy, cell_values)
+            yield ledger, code_fin_year_summaries
+        return
+
+    max_workers = jobs if jobs > 0 else (os.cpu_count() or 1)
+    with ProcessPoolExecutor(max_workers=max_workers,
+            initializer=configure_ledger_worker, initargs=(table, PROFILER is not None)) as executor:
+        pending = deque()
+        remaining = iter(codes)
+        for code in islice(remaining, 2 * max_workers):
+            pending.append(executor.submit(compute_worker_code_ledger, code, lot_policy, cell_values))
+        while pending:
+            ledger, code_fin_year_summaries, samples = pending.popleft().result()
+            for code in islice(remaining, 1):
+                pending.append(executor.submit(compute_worker_code_ledger, code, lot_policy, cell_values))
+            if samples:
+                PROFILER.merge(samples)
+            yield ledger, code_fin_year_summaries
+
+# Increase when the rows written for the same records change, so that code sheets are rebuilt
+LEDGER_VERSION = 2
+
+def record_fingerprint(table: RecordTable, row: int, lot_policy: str = "fifo", cell_values: str = "formulas") -> str:
+    # Every field that contributes to a code sheet. A file whose fields change (e.g. after a parser fix)
+    # will cause its code sheet to be rebuilt even though the file itself is unchanged.
+    fields = [table.trade_date(row), table.trade_type(row), table.code(row),
+        table.quantities[row], table.prices[row], table.brokerages[row]]
+    # The lot policy and cell values change the rows written, so they are included to force a rebuild when they change
+    fields += [lot_policy, cell_values, LEDGER_VERSION]
+    return hashlib.sha1(json.dumps(fields, default=_encode_field).encode("utf-8")).hexdigest()
+
+def code_manifest_entries(table: RecordTable, code: str, lot_policy: str = "fifo", cell_values: str = "formulas") -> list:
+    """Return the sorted [filename, fingerprint] of each record of a code of an indexed table.
+
+    """
+    return sorted([table.sources[row], record_fingerprint(table, row, lot_policy, cell_values)]
+        for row in table.by_code[code])
+
+def workbook_manifest_filename(filename: str) -> str:
+    return os.path.splitext(filename)[0] + ".sheets.json"
+
+class WorkbookManifest():
+    """Remembers what each code sheet of a workbook was built from, in a JSON file beside the workbook.
+
+    For each code sheet, in sheet order, the manifest holds the part of the xlsx file the sheet is stored in,
+    the [filename, fingerprint] of each of its records (see record_fingerprint) and its financial year summaries.
+    A later run can then tell which code sheets are unchanged without openpyxl reading the workbook, copy their
+    parts across as they are, and total the Summary sheet from the same numbers a full rebuild would.
+    The workbook's size and mtime are recorded too, as a workbook changed since (e.g. saved by Excel) may not
+    hold the same parts, as is the openpyxl version, which decides how sheets refer to the workbook's styles.
+
+    """
+
+    VERSION = 1
+
+    def __init__(self, filename: str) -> None:
+        self.filename = filename
+        # Code: {"sheet": part name, "records": [[filename, fingerprint]], "summaries": [summary dict]}
+        self.codes = {}
+
+    @staticmethod
+    def _workbook_settings(workbook_filename: str) -> dict:
+        import openpyxl
+        stat = os.stat(workbook_filename)
+        return {"version": WorkbookManifest.VERSION, "openpyxl": openpyxl.__version__,
+            "size": stat.st_size, "mtime": stat.st_mtime_ns}
+
+    def load(self, workbook_filename: str) -> bool:
+        """Read the manifest, returning whether it still describes the workbook.
+
+        """
+        if not (os.path.isfile(self.filename) and os.path.isfile(workbook_filename)):
+            return False
+        with open(self.filename, encoding="utf-8") as f:
+            data = json.load(f)
+        if data.get("settings") != self._workbook_settings(workbook_filename):
+            return False
+        self.codes = data["codes"]
+        return True
+
+    def save(self, workbook_filename: str) -> None:
+        with open(self.filename + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({"settings": self._workbook_settings(workbook_filename), "codes": self.codes}, f)
+        os.replace(self.filename + ".tmp", self.filename)
+
+def construct_investment_record_workbook(investment_records: List[InvestmentRecord], lot_policy: str = "fifo",
+        cell_values: str = "formulas", jobs: int = 1) -> "Workbook":
+    """Return a new write-only workbook holding a sheet for every code.
+
+    Each code's rows are computed in full before being streamed to its sheet, so the workbook never holds
+    the cells in memory. As with any write-only workbook, it can be saved once but not read or edited.
+    With more than one job, ledgers are computed by worker processes (see compute_code_ledgers) while
+    the sheets are written here in the same order, so the workbook is the same whatever jobs is.
+
+    """
+    from openpyxl import Workbook
+    workbook = Workbook(write_only=True)
+    # Created first so it is the first sheet
+    workbook.create_sheet(SUMMARY_SHEET)
+
+    normalise_codes(investment_records)
+    table = RecordTable.from_records(investment_records)
     all_fin_year_summaries = []
-    row_idx = 1
 
     # We will have a sheet for each code
-    for code in investment_records_by_code:
-        records = investment_records_by_code[code]
-        sheet = initialise_for_new_code(workbook, code, records)
-        current_date = records[0].trade_date
-        code_fin_year_summaries = []
-        # Row 1 used for heading
-        row_idx = 2
-        fisc_year_start_idx = 2
+    for ledger, code_fin_year_summaries in compute_code_ledgers(table, list(table.by_code), lot_policy, cell_values, jobs):
+        with profile_stage("code sheet", ledger.code):
+            write_code_sheet(workbook, ledger)
+        all_fin_year_summaries.append((ledger.code, code_fin_year_summaries))
 
-        for record in records:
-            row_idx, fisc_year_start_idx = fiscal_year_check(sheet, fisc_year_start_idx, row_idx, current_date, record.trade_date, code_fin_year_summaries, False)
-            current_date = record.trade_date
-            add_new_record_row(sheet, row_idx, record)
-            if record.trade_type.lower() in ("buy", "drp"):
-                cost_base_formula = "=" \
-                    + cell.get_column_letter(COLUMNS["Quantity"]) \
-                    + str(row_idx) + "*" \
-                    + cell.get_column_letter(COLUMNS["Average price"]) \
-                    + str(row_idx) + "+" \
-                    + cell.get_column_letter(COLUMNS["Brokerage"]) \
-                    + str(row_idx)                         
-                sheet.cell(row_idx, COLUMNS["Cost base"]).value = cost_base_formula
-            if record.trade_type.lower() in ("sell", "mfund redemption"):
+    add_summary_sheet(workbook, all_fin_year_summaries)
+    return workbook
+
+class StreamedWorkbook():
+    """Writes a new workbook a code at a time, holding only the Summary rows and the manifest until it is closed.
+
+    Given each code's ledger in turn, the sheets are the same as those of construct_investment_record_workbook.
+    The workbook's WorkbookManifest is written beside it, unless keep_manifest is False, as it holds an entry for
+    every record until the workbook is closed. After reuse_sheets, the sheets of codes whose records haven't changed
+    are copied from the existing workbook rather than written again, and need no ledger.
+
+    """
+
+    def __init__(self, filename: str, lot_policy: str = "fifo", cell_values: str = "formulas",
+            rolling_backup: bool = False, keep_manifest: bool = True) -> None:
+        from openpyxl import Workbook
+        self.filename = filename
+        self.lot_policy = lot_policy
+        self.cell_values = cell_values
+        self.rolling_backup = rolling_backup
+        self.workbook = Workbook(write_only=True)
+        # Created first so it is the first sheet
+        self.workbook.create_sheet(SUMMARY_SHEET)
+        self.all_fin_year_summaries = []
+        self.manifest = WorkbookManifest(workbook_manifest_filename(filename)) if keep_manifest else None
+        # Code: the existing workbook's manifest entry, for each code whose sheet is copied from it
+        self.reused = {}
+        # (empty sheet, part of the existing workbook to fill it with), for each copied sheet
+        self.copied_sheets = []
+
+    def reuse_sheets(self, table: RecordTable) -> list:
+        """Copy the existing workbook's sheets of codes of an indexed table whose records haven't changed.
+
+        Returns the codes whose sheets will be rebuilt or removed, which is every code if the existing workbook
+        has no manifest or has changed since it was written.
+
+        """
+        previous = WorkbookManifest(workbook_manifest_filename(self.filename))
+        if not previous.load(self.filename):
+            return list(table.by_code)
+        changed_codes = [code for code in previous.codes if code not in table.by_code]
+        for code in table.by_code:
+            entry = previous.codes.get(code)
+            if entry is not None and entry["records"] == code_manifest_entries(table, code, self.lot_policy, self.cell_values):
+                self.reused[code] = entry
+            else:
+                changed_codes.append(code)
+        if changed_codes and self.reused and len(self.reused) == len(table.by_code):
+            # Cells refer to the workbook's styles by position, which follows the order they are first used in.
+            # Every code sheet uses them in the same order, so they match as long as one code sheet is written.
+            # With no codes left there is nothing to copy, and the Summary sheet is written on its own.
+            code = next(iter(self.reused))
+            del self.reused[code]
+            changed_codes.append(code)
+        return changed_codes
+
+    def needs_ledger(self, code: str) -> bool:
+        return code not in self.reused
+
+    def write_code(self, table: RecordTable, code: str, ledger: CodeLedger, code_fin_year_summaries: list) -> None:
+        """Write the computed ledger of one code of an indexed table as the code's sheet, or copy its existing sheet.
+
+        The ledger must have been computed with the workbook's lot policy, and with its cell values or "both".
+        It is None for a code whose sheet is copied.
+
+        """
+        entry = self.reused.get(code)
+        if entry is not None:
+            # An empty sheet holding the place of the one copied in when the workbook is saved
+            self.copied_sheets.append((self.workbook.create_sheet(code), entry["sheet"]))
+            code_fin_year_summaries = entry["summaries"]
+        else:
+            with profile_stage("code sheet", code):
+                write_code_sheet(self.workbook, ledger.with_cell_values(self.cell_values))
+        self.all_fin_year_summaries.append((code, code_fin_year_summaries))
+        if self.manifest is not None:
+            records = entry["records"] if entry is not None \
+                else code_manifest_entries(table, code, self.lot_policy, self.cell_values)
+            self.manifest.codes[code] = {"sheet": None, "records": records, "summaries": code_fin_year_summaries}
+
+    def close(self) -> None:
+        add_summary_sheet(self.workbook, self.all_fin_year_summaries)
+        save_workbook(self.workbook, self.filename, self.rolling_backup, self.copied_sheets)
+        if self.manifest is None:
+            # A manifest of the workbook this one replaced no longer describes it
+            manifest_filename = workbook_manifest_filename(self.filename)
+            if os.path.isfile(manifest_filename):
+                os.remove(manifest_filename)
+            return
+        # Parts are named once the workbook is saved. The Summary sheet comes first.
+        for sheet in self.workbook.worksheets[1:]:
+            self.manifest.codes[sheet.title]["sheet"] = sheet.path[1:]
+        self.manifest.save(self.filename)
+
+    def discard(self) -> None:
+        # Nothing is written to the file until close, but each sheet's rows are streamed to a temporary file
+        # that openpyxl removes when Python exits, once the sheet has been closed
+        for sheet in self.workbook.worksheets:
+            sheet.close()
+
+CAPITAL_GAIN_COLUMNS = ["Capital gain <= 1 year", "Capital gain > 1 year"]
+# The date a lot that is never used up is closed on, later than any real date
+LOT_NEVER_CLOSED = datetime.max.toordinal() + 1
+
+class CodeHoldings():
+    """The index HoldingsIndex keeps for a single code.
+
+    dates holds the date of each of the code's records in sheet order, and held and cost_bases the quantity held
+    and its cost base once that record is included. Lots are kept in sheet order with the date each was used up,
+    and for each lot the dates of the sales drawing from it with the running total sold. lot_closed_tree is a
+    segment tree holding the latest date any lot in each range of lots was used up, so the lots still open
+    on a date are found without visiting those already used up. gains_by_year holds the capital gain totals
+    of each financial year, added up in the same order as on the code sheet.
+
+    """
+
+    def __init__(self) -> None:
+        self.dates = array("l")
+        self.held = array("d")
+        self.cost_bases = array("d")
+        self.lot_rows = array("l")
+        self.lot_dates = array("l")
+        self.lot_closed = array("l")
+        self.lot_sale_dates = {}
+        self.lot_sold = {}
+        self.lot_closed_tree = array("l")
+        self.gains_by_year = {}
+
+    def build_lot_closed_tree(self) -> None:
+        # Leaves (lots) start at index tree_size, and each node holds the later of its two children
+        tree_size = 1
+        while tree_size < len(self.lot_closed):
+            tree_size *= 2
+        tree = array("l", [0]) * (2 * tree_size)
+        tree[tree_size:tree_size + len(self.lot_closed)] = self.lot_closed
+        for node in range(tree_size - 1, 0, -1):
+            tree[node] = max(tree[2 * node], tree[2 * node + 1])
+        self.lot_closed_tree = tree
+
+    def open_lot_idxs(self, num_lots: int, date_ordinal: int) -> list:
+        """Return the positions, in order, of the lots among the first num_lots that were still open after a date.
+
+        """
+        tree = self.lot_closed_tree
+        tree_size = len(tree) // 2
+        idxs = []
+        # Stack of (node, position of its first lot, number of lots under it)
+        stack = [(1, 0, tree_size)]
+        while stack:
+            node, first_idx, num_node_lots = stack.pop()
+            if first_idx >= num_lots or tree[node] <= date_ordinal:
+                continue
+            if node >= tree_size:
+                idxs.append(first_idx)
+                continue
+            half = num_node_lots // 2
+            # The right child is pushed first so that lots come off the stack in order
+            stack.append((2 * node + 1, first_idx + half, half))
+            stack.append((2 * node, first_idx, half))
+        return idxs
+
+class HoldingsIndex():
+    """Answers what was held of each code on any date, and the gains realised in any financial year.
+
+    Built once from the records, without building any sheets, and then reused for any number of queries.
+    Sales are matched against lots by the same LotMatcher as the code sheets, so every answer agrees with
+    the workbook written with the same lot policy. Holdings and their cost base as of a date are a binary search
+    of each code's record dates into prefix sums, and realised gains are looked up by financial year.
+    Open lots are found by a binary search of the lots' dates, a search of a tree of the dates they were used up,
+    and a binary search of the sales drawing from each open lot.
+
+    """
+
+    def __init__(self, table: RecordTable, lot_policy: str = "fifo") -> None:
+        """Index an indexed table. Its available column is used while matching sales, as when building sheets.
+
+        """
+        self.table = table
+        self.lot_policy = lot_policy
+        self.by_code = {code: self._index_code(code) for code in table.by_code}
+
+    @classmethod
+    def from_records(cls, investment_records: List[InvestmentRecord], lot_policy: str = "fifo") -> "HoldingsIndex":
+        normalise_codes(investment_records)
+        return cls(RecordTable.from_records(investment_records), lot_policy)
+
+    @property
+    def codes(self) -> list:
+        return list(self.by_code)
+
+    def _index_code(self, code: str) -> CodeHoldings:
+        table = self.table
+        holdings = CodeHoldings()
+        lot_matcher = LotMatcher(table, self.lot_policy)
+        # Lot row: position in holdings' lot columns, for lots with some quantity left
+        open_lots = {}
+        held = 0.0
+        cost_base = 0.0
+        for row in table.by_code[code]:
+            date = table.dates[row]
+            if not table.is_sale(row):
+                lot_matcher.add_lot(row)
+                held += table.quantities[row]
+                cost_base += table.quantities[row] * table.prices[row] + table.brokerages[row]
+                # A lot of nothing is never drawn from, so it is used up as soon as it is opened
+                if table.quantities[row] > 0:
+                    open_lots[row] = len(holdings.lot_rows)
+                holdings.lot_rows.append(row)
+                holdings.lot_dates.append(date)
+                holdings.lot_closed.append(LOT_NEVER_CLOSED if table.quantities[row] > 0 else date)
+                holdings.lot_sale_dates[row] = array("l")
+                holdings.lot_sold[row] = array("d")
+            else:
                 try:
-                    recs_and_quants_sold = find_records_to_sell_fifo(records, record)
-                except Exception as e:
-                    sheet.cell(row_idx, COLUMNS["History"]).value = str(e)
-                else:
-                    pass
-                    row_idx += add_sale_data(sheet, record, recs_and_quants_sold)
-            row_idx += 1
+                    rows_and_quants_sold = lot_matcher.sell(row)
+                    matched = True
+                except Exception:
+                    # The sale used up every open lot before finding they weren't enough, unless it was a sale
+                    # of nothing, which uses no lots. Either way it has no gain on the code sheet.
+                    rows_and_quants_sold = [(lot_row, table.quantities[lot_row] - self._sold(holdings, lot_row))
+                        for lot_row in open_lots] if table.quantities[row] > 0 else []
+                    matched = False
+                for lot_row, quantity in rows_and_quants_sold:
+                    held -= quantity
+                    cost_base -= quantity * table.prices[lot_row] \
+                        + table.brokerages[lot_row] * quantity / table.quantities[lot_row]
+                    holdings.lot_sale_dates[lot_row].append(date)
+                    holdings.lot_sold[lot_row].append(self._sold(holdings, lot_row) + quantity)
+                    if table.available[lot_row] == 0:
+                        holdings.lot_closed[open_lots.pop(lot_row)] = date
+                    if matched:
+                        _, capital_gain, capital_gain_column = sale_part_gain(table, row, lot_row, quantity)
+                        fiscal_year = fiscal_year_of(date)
+                        if fiscal_year not in holdings.gains_by_year:
+                            holdings.gains_by_year[fiscal_year] = dict.fromkeys(CAPITAL_GAIN_COLUMNS, 0.0)
+                        holdings.gains_by_year[fiscal_year][capital_gain_column] += capital_gain
+            holdings.dates.append(date)
+            holdings.held.append(held)
+            holdings.cost_bases.append(cost_base)
+        holdings.build_lot_closed_tree()
+        return holdings
+
+    @staticmethod
+    def _sold(holdings: CodeHoldings, lot_row: int) -> float:
+        sold = holdings.lot_sold[lot_row]
+        return sold[-1] if sold else 0.0
+
+    def _record_idx(self, code: str, date: datetime) -> int:
+        # The last of the code's records on or before the date, or -1 if there are none
+        return bisect_right(self.by_code[code].dates, date.toordinal()) - 1
+
+    def holdings(self, code: str, date: datetime) -> float:
+        """Return the quantity of a code held at the end of a date.
 
-        fiscal_year_check(sheet, fisc_year_start_idx, row_idx, current_date, current_date, code_fin_year_summaries, True)
-        all_fin_year_summaries.append((code, code_fin_year_summaries))
+        """
+        idx = self._record_idx(code, date)
+        return self.by_code[code].held[idx] if idx >= 0 else 0.0
 
-        format_code_sheet(sheet)
-    
-    add_summary_sheet(workbook, all_fin_year_summaries)
-    return workbook
+    def cost_base(self, code: str, date: datetime) -> float:
+        """Return the cost base, including brokerage, of the quantity of a code held at the end of a date.
+
+        """
+        idx = self._record_idx(code, date)
+        return self.by_code[code].cost_bases[idx] if idx >= 0 else 0.0
+
+    def open_lots(self, code: str, date: datetime) -> list:
+        """Return the lots of a code with some quantity left at the end of a date, in sheet order.
+
+        Each lot is a dict of Date, Transaction type, Quantity (the quantity left), Average price,
+        Cost base (of the quantity left) and Filename.
+
+        """
+        table = self.table
+        holdings = self.by_code[code]
+        date_ordinal = date.toordinal()
+        lots = []
+        for idx in holdings.open_lot_idxs(bisect_right(holdings.lot_dates, date_ordinal), date_ordinal):
+            row = holdings.lot_rows[idx]
+            num_sales = bisect_right(holdings.lot_sale_dates[row], date_ordinal)
+            quantity = table.quantities[row] - (holdings.lot_sold[row][num_sales - 1] if num_sales else 0.0)
+            lots.append({
+                "Date": table.trade_date(row),
+                "Transaction type": table.trade_type(row),
+                "Quantity": quantity,
+                "Average price": table.prices[row],
+                "Cost base": quantity * table.prices[row] + table.brokerages[row] * quantity / table.quantities[row],
+                "Filename": table.sources[row]
+            })
+        return lots
+
+    def realised_gains(self, fiscal_year: int, codes: list = None) -> dict:
+        """Return the capital gains realised in a financial year by some codes together.
+
+        The result is a dict of the CAPITAL_GAIN_COLUMNS and Net capital gain, totalled as on the code sheets
+        and the Summary sheet.
+
+        Args:
+            fiscal_year: The financial year, given by the year it ends in (e.g. 2020 for 2019-2020).
+            codes: Optional list of codes, e.g. [code] for a single code. By default the gains of every code are added up.
+
+        """
+        totals = dict.fromkeys(CAPITAL_GAIN_COLUMNS + ["Net capital gain"], 0.0)
+        for code in (codes if codes is not None else self.by_code):
+            code_totals = self.by_code[code].gains_by_year.get(fiscal_year)
+            if code_totals is None:
+                continue
+            for column_name in CAPITAL_GAIN_COLUMNS:
+                totals[column_name] += code_totals[column_name]
+            # Each code's net gain is worked out on its own sheet, and the Summary sheet adds them up
+            totals["Net capital gain"] += code_totals["Capital gain <= 1 year"] + (code_totals["Capital gain > 1 year"] / 2)
+        return totals
+
+# Other formats the ledger rows can be written in, each holding the same rows as the code sheets in turn,
+# with the same COLUMNS. Cells hold values rather than formulas, and the END OF FINANCIAL YEAR rows are left out
+# so that every column holds a single type. The Summary sheet's totals can be recalculated from the rows.
+OUTPUT_FORMATS = ("xlsx", "csv", "sqlite", "parquet")
+# Rows are written in batches of this many, so only one code's ledger and one batch are held at once
+EXPORT_BATCH_ROWS = 1000
+NUMBER_COLUMNS = ["Quantity", "Subquantity", "Average price", "Brokerage"] + CALCULATED_COLUMNS
+
+def ledger_export_rows(ledger: CodeLedger):
+    """Yield the record and lot match rows of a computed ledger, leaving out its headings and financial year totals.
+
+    """
+    for row_idx, row in enumerate(ledger.rows, start=1):
+        # Styled rows are the headings and financial year totals
+        if row_idx not in ledger.row_styles:
+            yield row
+
+def _export_date(value):
+    # Every record is dated to the day, so dates are written without a time
+    return value.date().isoformat() if isinstance(value, datetime) else value
+
+class CsvExport():
+    def __init__(self, filename: str) -> None:
+        self.file = open(filename, "w", newline="", encoding="utf-8")
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(COLUMNS)
+
+    def write(self, rows: list) -> None:
+        date_idx = COLUMNS["Date"] - 1
+        for row in rows:
+            row[date_idx] = _export_date(row[date_idx])
+        self.writer.writerows(rows)
+
+    def close(self) -> None:
+        self.file.close()
+
+class SqliteExport():
+    TABLE = "ledger"
+
+    def __init__(self, filename: str) -> None:
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute("CREATE TABLE " + self.TABLE + " (" + ", ".join(
+            '"' + column_name + '" ' + ("REAL" if column_name in NUMBER_COLUMNS else "TEXT") for column_name in COLUMNS) + ")")
+        self.insert = "INSERT INTO " + self.TABLE + " VALUES (" + ", ".join("?" * len(COLUMNS)) + ")"
+
+    def write(self, rows: list) -> None:
+        date_idx = COLUMNS["Date"] - 1
+        for row in rows:
+            row[date_idx] = _export_date(row[date_idx])
+        self.connection.executemany(self.insert, rows)
+
+    def close(self) -> None:
+        # Every batch is committed at once, so the file is written in one transaction
+        self.connection.commit()
+        self.connection.close()
+
+class ParquetExport():
+    def __init__(self, filename: str) -> None:
+        # pyarrow is only imported when a parquet file is asked for
+        import pyarrow
+        import pyarrow.parquet
+        self.pyarrow = pyarrow
+        self.schema = pyarrow.schema([
+            (column_name, pyarrow.date32() if column_name == "Date"
+                else pyarrow.float64() if column_name in NUMBER_COLUMNS else pyarrow.string())
+            for column_name in COLUMNS])
+        self.writer = pyarrow.parquet.ParquetWriter(filename, self.schema)
+
+    def write(self, rows: list) -> None:
+        date_idx = COLUMNS["Date"] - 1
+        for row in rows:
+            if isinstance(row[date_idx], datetime):
+                row[date_idx] = row[date_idx].date()
+        # Each batch becomes a row group
+        columns = [self.pyarrow.array([row[column_idx] for row in rows], field.type)
+            for column_idx, field in enumerate(self.schema)]
+        self.writer.write_table(self.pyarrow.Table.from_arrays(columns, schema=self.schema))
+
+    def close(self) -> None:
+        self.writer.close()
+
+EXPORTS = {"csv": CsvExport, "sqlite": SqliteExport, "parquet": ParquetExport}
+
+class StreamedExport():
+    """Writes ledger rows to a csv, sqlite or parquet file as they are given, in batches of EXPORT_BATCH_ROWS.
+
+    The file is written under a temporary name and only moved into place by close, so readers never see a partial file.
+
+    """
+
+    # Exported calculated cells always hold values
+    cell_values = "values"
+
+    def __init__(self, output_format: str, filename: str) -> None:
+        self.output_format = output_format
+        self.filename = filename
+        self.temp_filename = filename + ".tmp"
+        if os.path.isfile(self.temp_filename):
+            os.remove(self.temp_filename)
+        self.export = EXPORTS[output_format](self.temp_filename)
+        self.pending = []
+        self.num_rows = 0
+
+    def needs_ledger(self, code: str) -> bool:
+        return True
+
+    def write_rows(self, rows: list) -> None:
+        self.pending.extend(rows)
+        while len(self.pending) >= EXPORT_BATCH_ROWS:
+            self.export.write(self.pending[:EXPORT_BATCH_ROWS])
+            del self.pending[:EXPORT_BATCH_ROWS]
+            self.num_rows += EXPORT_BATCH_ROWS
+
+    def write_code(self, table: RecordTable, code: str, ledger: CodeLedger, code_fin_year_summaries: list) -> None:
+        """Write the rows of the computed ledger of one code, which must hold values or "both".
+
+        """
+        with profile_stage("export " + self.output_format):
+            # Copied, as exports convert dates in place and the ledger may be shared with other writers
+            self.write_rows([list(row) for row in ledger_export_rows(ledger.with_cell_values(self.cell_values))])
+
+    def close(self) -> int:
+        """Write any rows still pending and move the file into place, returning the number of rows written.
+
+        """
+        try:
+            if self.pending:
+                self.export.write(self.pending)
+                self.num_rows += len(self.pending)
+                self.pending = []
+        finally:
+            self.export.close()
+        os.replace(self.temp_filename, self.filename)
+        return self.num_rows
+
+    def discard(self) -> None:
+        self.export.close()
+        os.remove(self.temp_filename)
+
+def open_output_writers(output_formats: list, lot_policy: str = "fifo", cell_values: str = "formulas",
+        rolling_backup: bool = False, keep_manifest: bool = True) -> list:
+    """Return a StreamedWorkbook or StreamedExport for each output format, writing Investment_Record_Tally.<format>.
+
+    See StreamedWorkbook for rolling_backup and keep_manifest.
+
+    """
+    writers = []
+    for output_format in output_formats:
+        filename = "Investment_Record_Tally." + output_format
+        if output_format == "xlsx":
+            writers.append(StreamedWorkbook(filename, lot_policy, cell_values, rolling_backup, keep_manifest))
+        else:
+            writers.append(StreamedExport(output_format, filename))
+    return writers
+
+def shared_cell_values(writers: list) -> str:
+    # A ledger holding both values and formulas can be converted to whichever one a writer wants
+    cell_values = {writer.cell_values for writer in writers}
+    return cell_values.pop() if len(cell_values) == 1 else "both"
+
+def write_code_ledgers(table: RecordTable, writers: list, lot_policy: str = "fifo", jobs: int = 1) -> None:
+    """Compute the ledger of every code of an indexed table once, and give it to each of writers in turn.
+
+    Every output format is written from the same ledgers, computed with the cell values they all need
+    (see shared_cell_values), rather than each format computing its own. A code's ledger is only computed
+    if a writer needs it, and is None otherwise. The writers are left open.
+
+    Args:
+        table: An indexed table holding the records of every code.
+        writers: StreamedWorkbook and StreamedExport writers, or anything else with their cell_values attribute
+            and needs_ledger and write_code methods.
+        lot_policy: How sales are matched against earlier lots. One of LotMatcher.POLICIES.
+        jobs: The number of worker processes used to compute the ledgers (see compute_code_ledgers).
+
+    """
+    ledger_codes = [code for code in table.by_code if any(writer.needs_ledger(code) for writer in writers)]
+    ledgers = compute_code_ledgers(table, ledger_codes, lot_policy, shared_cell_values(writers), jobs)
+    ledger_codes = set(ledger_codes)
+    for code in table.by_code:
+        ledger, code_fin_year_summaries = next(ledgers) if code in ledger_codes else (None, None)
+        for writer in writers:
+            writer.write_code(table, code, ledger, code_fin_year_summaries)
+
+def add_record_input_arguments(parser: argparse.ArgumentParser) -> None:
+    """Add the arguments choosing which files are read and how, shared by the tally and the query command.
+
+    """
+    parser.add_argument("--extraction-backend", action="append", metavar="[RECORD_TYPE=]BACKEND",
+        help="How the text of files is extracted, from " + ", ".join(EXTRACTION_BACKENDS) + " (default: pypdf2). "
+            "Prefix with a record type (e.g. WH_ContractNote=text) to choose the backend of that type only. May be repeated. "
+            "The text backend reads text extracted beforehand from <pdf filename>.txt.")
+    parser.add_argument("--include", action="append", metavar="GLOB",
+        help="Only read files whose path relative to the search path matches this glob. May be repeated.")
+    parser.add_argument("--exclude", action="append", metavar="GLOB",
+        help="Skip files and directories whose path relative to the search path matches this glob. May be repeated.")
+    parser.add_argument("--cache-file", default="Investment_Record_Tally.cache.sqlite",
+        help="SQLite file used to cache text and fields extracted from each pdf (default: %(default)s).")
+    parser.add_argument("--no-cache", action="store_true",
+        help="Read and parse every pdf without using the extraction cache.")
+
+def build_argument_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description="Digest investment records from multiple PDFs into a single spreadsheet.",
+        epilog="Run with query as the first argument to report holdings and realised gains instead (see query --help).")
+    parser.add_argument("path", nargs="?", default=".",
+        help="The path to search. All subdirectories within the path are also searched.")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+        help="Number of worker processes used to read the pdfs and compute the code sheets. "
+        + "Use 0 for one per CPU core (default: 1).")
+    parser.add_argument("-i", "--incremental", action="store_true",
+        help="Update an existing Investment_Record_Tally.xlsx, rebuilding only the sheets of codes whose records changed "
+            "and copying the rest across as they are.")
+    parser.add_argument("--stream", action="store_true",
+        help="Read and write one code at a time, so memory doesn't grow with the number of files. Each code's files "
+            "must be found together, e.g. in a directory per code. Can't be used with --incremental or --watch.")
+    parser.add_argument("--window", type=int, default=64, metavar="N",
+        help="Most files being read at once by the workers in --stream mode (default: %(default)s).")
+    parser.add_argument("--lot-policy", choices=LotMatcher.POLICIES, default="fifo",
+        help="Which lots a sale is matched against first (default: %(default)s).")
+    parser.add_argument("-f", "--output-format", action="append", choices=OUTPUT_FORMATS,
+        help="Format of the output file, Investment_Record_Tally.<format>. May be repeated to write several formats "
+            "(default: xlsx). Formats other than xlsx hold the code sheets' rows one after another, with values rather than formulas.")
+    parser.add_argument("--cell-values", choices=CELL_VALUES, default="formulas",
+        help="Whether cost bases, gains and totals are written as formulas, calculated values, "
+            "or values with the formulas in extra columns (default: %(default)s).")
+    add_record_input_arguments(parser)
+    parser.add_argument("--ocr-dpi", type=int, default=OCR_DPI,
+        help="Resolution pages are rasterized at for OCR (default: %(default)s).")
+    parser.add_argument("--ocr-workers", type=int, default=OCR_WORKERS,
+        help="Number of tesseract processes run at once, per job (default: %(default)s).")
+    parser.add_argument("--ocr-report", action="store_true",
+        help="Print the OCR time of each file that needed OCR.")
+    parser.add_argument("--profile", nargs="?", const="text", choices=("text", "json"),
+        help="Time each stage of the run, and report the total and p50/p95/max time of each stage, "
+            "the slowest files and peak memory, as text or json (default: text).")
+    parser.add_argument("--profile-output", metavar="FILE",
+        help="Write the --profile report to FILE rather than printing it. In --watch mode it is replaced after each update.")
+    parser.add_argument("--profile-top", type=int, default=10, metavar="N",
+        help="Number of slowest files in the --profile report (default: %(default)s).")
+    parser.add_argument("--scan-manifest", default="Investment_Record_Tally.scan.json",
+        help="File remembering the last scan, so only changed directories are listed again (default: %(default)s).")
+    parser.add_argument("--full-scan", action="store_true",
+        help="List every directory rather than trusting the scan manifest.")
+    parser.add_argument("-w", "--watch", action="store_true",
+        help="Keep running, and update the workbook whenever new or changed files appear.")
+    parser.add_argument("--watch-interval", type=float, default=30, metavar="SECONDS",
+        help="How often to check for new files in --watch mode (default: %(default)s).")
+    parser.add_argument("--rebuild-cache", action="store_true",
+        help="Empty the extraction cache before reading the pdfs.")
+    parser.add_argument("--cache-max-age", type=float, default=180, metavar="DAYS",
+        help="Evict cache entries that haven't been used for this many days (default: %(default)s).")
+    parser.add_argument("--cache-max-entries", type=int, default=None, metavar="N",
+        help="Evict the least recently used cache entries beyond this many.")
+    return parser
+
+def parse_extraction_backends(values: list) -> dict:
+    """Return a dict of record type: backend name from --extraction-backend values, with None for every type.
+
+    """
+    record_types = {parser.name: record_type for record_type, parser in RECORD_PARSERS.items()}
+    backends = {}
+    for value in values or []:
+        type_name, _, backend = value.rpartition("=")
+        if type_name and type_name not in record_types:
+            raise ValueError("Unknown record type " + type_name + ", expected one of " + ", ".join(record_types))
+        backends[record_types[type_name] if type_name else None] = backend
+    return backends
+
+def parse_date_argument(value: str) -> datetime:
+    try:
+        return datetime.strptime(value, "%Y-%m-%d")
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected a date as YYYY-MM-DD, not " + value)
+
+def build_query_argument_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog=os.path.basename(sys.argv[0]) + " query",
+        description="Report holdings, open lots and realised gains from the investment records, without writing a spreadsheet.")
+    parser.add_argument("path", nargs="?", default=".",
+        help="The path to search. All subdirectories within the path are also searched.")
+    parser.add_argument("--code", action="append",
+        help="Only report this code. May be repeated (default: every code, leaving out those not held).")
+    parser.add_argument("--as-of", type=parse_date_argument, metavar="YYYY-MM-DD",
+        help="Report the quantity held of each code, and its cost base, at the end of this date (default: today).")
+    parser.add_argument("--lots", action="store_true",
+        help="Also list the open lots of each code as of --as-of.")
+    parser.add_argument("--fy", type=int, action="append", metavar="YEAR",
+        help="Report the capital gains realised in the financial year ending in YEAR (e.g. 2020 for 2019-2020). "
+            "May be repeated. Holdings are only reported as well if --as-of or --lots is given.")
+    parser.add_argument("--json", action="store_true",
+        help="Print the report as json.")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+        help="Number of worker processes used to read the pdfs. Use 0 for one per CPU core (default: 1).")
+    parser.add_argument("--lot-policy", choices=LotMatcher.POLICIES, default="fifo",
+        help="Which lots a sale is matched against first (default: %(default)s).")
+    add_record_input_arguments(parser)
+    return parser
+
+def load_holdings_index(args: argparse.Namespace) -> HoldingsIndex:
+    """Read every file under args.path, and index the records for queries.
+
+    """
+    cache_filename = None if args.no_cache else args.cache_file
+    filenames = get_investment_record_filenames(args.path, args.include, args.exclude)
+    investment_records, failures = load_investment_records(filenames, args.jobs, None, cache_filename)
+    if cache_filename:
+        close_extraction_cache(cache_filename)
+    for filename, error in failures:
+        print("Failed to process " + filename + ": " + error, file=sys.stderr)
+    return HoldingsIndex.from_records(investment_records, args.lot_policy)
+
+def answer_query(index: HoldingsIndex, codes: list, as_of: datetime = None, lots: bool = False,
+        fiscal_years: list = None) -> dict:
+    """Return a dict answering a query of an index, as asked by the query command.
+
+    Args:
+        index: The records to query.
+        codes: The codes to report, or None for every code held as of as_of (and every code for gains).
+        as_of: Optional date to report the holdings and cost base of each code at the end of.
+        lots: Whether to report the open lots of each code as of as_of too.
+        fiscal_years: Optional list of financial years, by the year they end in, to report the realised gains of.
+
+    """
+    answer = {}
+    if as_of is not None:
+        holdings_codes = codes if codes is not None else [code for code in index.codes if index.holdings(code, as_of)]
+        answer["as_of"] = as_of
+        answer["holdings"] = {code: {"Quantity": index.holdings(code, as_of), "Cost base": index.cost_base(code, as_of)}
+            for code in holdings_codes}
+        if lots:
+            answer["open_lots"] = {code: index.open_lots(code, as_of) for code in holdings_codes}
+    if fiscal_years:
+        gains_codes = codes if codes is not None else index.codes
+        answer["realised_gains"] = {}
+        for fiscal_year in fiscal_years:
+            gains = {code: index.realised_gains(fiscal_year, [code]) for code in gains_codes}
+            gains["Total"] = index.realised_gains(fiscal_year, gains_codes)
+            answer["realised_gains"][financial_year_label(fiscal_year)] = gains
+    return answer
+
+def _query_json_field(value):
+    if isinstance(value, datetime):
+        return value.date().isoformat()
+    raise TypeError("Cannot write " + type(value).__name__ + " as json")
+
+def format_query_answer(answer: dict) -> str:
+    lines = []
+    if "holdings" in answer:
+        lines.append("Holdings at the end of " + answer["as_of"].strftime("%d/%m/%Y"))
+        lines.append("{:<10} {:>14} {:>14}".format("Code", "Quantity", "Cost base"))
+        for code, holding in answer["holdings"].items():
+            lines.append("{:<10} {:>14,.4f} {:>14,.2f}".format(code, holding["Quantity"], holding["Cost base"]))
+    for code, lots in answer.get("open_lots", {}).items():
+        lines.append("")
+        lines.append("Open lots of " + code)
+        lines.append("{:<10} {:<16} {:>14} {:>14} {:>14}  {}".format(
+            "Date", "Transaction type", "Quantity", "Average price", "Cost base", "Filename"))
+        for lot in lots:
+            lines.append("{:<10} {:<16} {:>14,.4f} {:>14,.4f} {:>14,.2f}  {}".format(lot["Date"].strftime("%d/%m/%Y"),
+                lot["Transaction type"], lot["Quantity"], lot["Average price"], lot["Cost base"], lot["Filename"]))
+    for financial_year, gains in answer.get("realised_gains", {}).items():
+        if lines:
+            lines.append("")
+        lines.append("Capital gains realised in " + financial_year)
+        lines.append("{:<10} {:>22} {:>22} {:>22}".format("Code", *(CAPITAL_GAIN_COLUMNS + ["Net capital gain"])))
+        for code, totals in gains.items():
+            lines.append("{:<10} {:>22,.2f} {:>22,.2f} {:>22,.2f}".format(
+                code, *(totals[column_name] for column_name in CAPITAL_GAIN_COLUMNS + ["Net capital gain"])))
+    return "\n".join(lines)
+
+def query_investment_records(argv: list) -> None:
+    """Run the query command, with the arguments that follow the word query.
+
+    """
+    query_argument_parser = build_query_argument_parser()
+    args = query_argument_parser.parse_args(argv)
+    try:
+        configure_extraction_backends(parse_extraction_backends(args.extraction_backend))
+    except ValueError as e:
+        query_argument_parser.error(str(e))
+    as_of = args.as_of
+    if as_of is None and (args.lots or not args.fy):
+        as_of = datetime.combine(datetime.now().date(), datetime.min.time())
+    index = load_holdings_index(args)
+    if args.code:
+        unknown_codes = [code for code in args.code if code not in index.by_code]
+        if unknown_codes:
+            query_argument_parser.error("no records of " + ", ".join(unknown_codes))
+    answer = answer_query(index, args.code, as_of, args.lots, args.fy)
+    print(json.dumps(answer, indent=4, default=_query_json_field) if args.json else format_query_answer(answer))
 
 def display_help():
     """Print a help message for this script to the terminal.
     """
-    raise Exception("To be completed.")
+    build_argument_parser().print_help()
+
+def save_workbook(workbook: "Workbook", filename: str, rolling_backup: bool = False, copied_sheets: list = None):
+    """Save a workbook under a temporary name, then move any existing file to a backup and put the workbook in its place.
+
+    Args:
+        workbook: The workbook to save.
+        filename: The file to write.
+        rolling_backup: Replace a single <filename>.bak backup, rather than keeping a timestamped one per save.
+        copied_sheets: Optional list of (empty sheet of workbook, part of the existing file), for sheets whose
+            content is copied from the existing file (see copy_sheet_parts).
 
-def save_workbook(workbook: Workbook, filename: str):
+    """
+    temp_filename = filename + ".tmp"
+    with profile_stage("save"):
+        workbook.save(temp_filename)
+    if copied_sheets:
+        with profile_stage("copy sheets"):
+            copy_sheet_parts(filename, temp_filename,
+                {sheet.path[1:]: previous_part for sheet, previous_part in copied_sheets})
     if os.path.isfile(filename):
-        os.rename(filename, filename+datetime.now().strftime(".%Y-%m-%d.%H.%M.%S.bak"))    
-    workbook.save(filename)    
- 
-if __name__ == "__main__":
-    if(len(sys.argv) > 1):
-            if(sys.argv[1] in ["-h", "help"]):
-                display_help()
-                exit()
-            else:
-                path_to_search = sys.argv[1]
-    else:
-        path_to_search = "."
+        if rolling_backup:
+            # A single backup is kept, so repeated updates don't pile up backups
+            os.replace(filename, filename+".bak")
+        else:
+            os.rename(filename, filename+datetime.now().strftime(".%Y-%m-%d.%H.%M.%S.bak"))    
+    os.replace(temp_filename, filename)
 
-    filenames = get_investment_record_filenames(path_to_search)
-    progress_bar = ChargingBar('Processing', max=len(filenames))
-    investment_records = []
-    for filename, record_type in filenames:
-        investment_records.append(InvestmentRecord(filename, record_type))
-        progress_bar.next()
+def copy_sheet_parts(previous_filename: str, filename: str, copied_parts: dict) -> None:
+    """Replace parts of the xlsx file filename with parts of previous_filename, which are copied across as they are.
+
+    Sheets written by openpyxl hold their strings inline and refer to the workbook's styles by position, so a sheet's
+    part can be moved to another workbook with the same styles without reading it.
+
+    Args:
+        previous_filename: The xlsx file to copy parts from.
+        filename: The xlsx file to copy parts into.
+        copied_parts: Dict of part of filename: part of previous_filename to take its place.
+
+    """
+    spliced_filename = filename + ".spliced"
+    with zipfile.ZipFile(previous_filename) as previous, zipfile.ZipFile(filename) as new:
+        if previous.read("xl/styles.xml") != new.read("xl/styles.xml"):
+            raise Exception("Can't copy sheets from " + previous_filename + " as its styles have changed. "
+                "Run without --incremental to rebuild it.")
+        with zipfile.ZipFile(spliced_filename, "w", zipfile.ZIP_DEFLATED, allowZip64=True) as spliced:
+            for info in new.infolist():
+                source, name = (previous, copied_parts[info.filename]) if info.filename in copied_parts \
+                    else (new, info.filename)
+                part = zipfile.ZipInfo(info.filename, info.date_time)
+                part.compress_type = zipfile.ZIP_DEFLATED
+                # Known up front, so zip64 is only used if the part needs it
+                part.file_size = source.getinfo(name).file_size
+                with source.open(name) as source_part, spliced.open(part, "w") as spliced_part:
+                    shutil.copyfileobj(source_part, spliced_part, 1 << 20)
+    os.replace(spliced_filename, filename)
+
+def tally_investment_records(args: argparse.Namespace, filenames: list, records_by_filename: dict, incremental: bool,
+        rolling_backup: bool = False) -> None:
+    """Read any files not yet in records_by_filename, then write the workbook and any other output formats.
+
+    Only the workbook is updated incrementally. Other formats are cheap to write, so are always written in full.
+
+    Args:
+        args: Parsed command line arguments.
+        filenames: Every (filename, record_type) to include, in the order they were found.
+        records_by_filename: Dict of filename: list of records, for files that have already been read.
+            Newly read files are added to it.
+        incremental: Update the existing workbook, rather than building a new one.
+        rolling_backup: Replace a single <workbook>.bak backup, rather than keeping a timestamped one per save.
+
+    """
+    cache_filename = None if args.no_cache else args.cache_file
+    to_read = [(filename, record_type) for filename, record_type in filenames if filename not in records_by_filename]
+    from progress.bar import ChargingBar
+    progress_bar = ChargingBar('Processing', max=len(to_read))
+    new_records, failures = load_investment_records(to_read, args.jobs, progress_bar, cache_filename)
     progress_bar.finish()
-    workbook = construct_investment_record_workbook(investment_records)
-    save_workbook(workbook, "Investment_Record_Tally.xlsx")
\ No newline at end of file
+    for record in new_records:
+        records_by_filename.setdefault(record.filename, []).append(record)
+    if cache_filename:
+        get_extraction_cache(cache_filename).evict(args.cache_max_age, args.cache_max_entries)
+        close_extraction_cache(cache_filename)
+    for filename, error in failures:
+        print("Failed to process " + filename + ": " + error, file=sys.stderr)
+    if args.ocr_report:
+        print_ocr_report(new_records)
+
+    investment_records = [record for filename, record_type in filenames for record in records_by_filename.get(filename, [])]
+    normalise_codes(investment_records)
+    output_formats = args.output_format or ["xlsx"]
+    table = RecordTable.from_records(investment_records)
+    # Every format shares one computation of each code's ledger
+    writers = open_output_writers(output_formats, args.lot_policy, args.cell_values, rolling_backup)
+    if incremental and "xlsx" in output_formats:
+        workbook = writers[output_formats.index("xlsx")]
+        changed_codes = workbook.reuse_sheets(table)
+        print("Updated " + str(len(changed_codes)) + " code sheet(s): " + ", ".join(changed_codes))
+        if not changed_codes:
+            writers.remove(workbook)
+            workbook.discard()
+    if not writers:
+        return
+    try:
+        write_code_ledgers(table, writers, args.lot_policy, args.jobs)
+    except BaseException:
+        for writer in writers:
+            writer.discard()
+        raise
+    for writer in writers:
+        writer.close()
+
+def stream_investment_records(args: argparse.Namespace) -> None:
+    """Scan, read and tally the files under args.path a code at a time, writing each code as soon as its files are read.
+
+    The stages are generators, each taking from the one before only when it needs more: the scan finds files,
+    which are read by up to args.window at a time, whose records are gathered into codes, each of which is written
+    to every output format when the next code begins. Memory is bounded by the window and the largest code,
+    however many files there are. Each code's files must be found together (see iter_code_groups).
+
+    Raises CodeNotGroupedError, before any output is written, if a code's files aren't together.
+
+    """
+    cache_filename = None if args.no_cache else args.cache_file
+    filenames = ((filename, record_type) for filename, record_type, size, mtime in
+        scan_investment_record_files(args.path, args.include, args.exclude))
+    loaded_files = iter_investment_record_files(filenames, args.jobs, args.window, cache_filename)
+    from progress.counter import Counter
+    progress_counter = Counter("Processing ")
+    failures = []
+    # Only kept for the report, as it holds every record that needed OCR
+    ocr_records = []
+
+    def iter_loaded_records():
+        for filename, record_type, records, error in loaded_files:
+            progress_counter.next()
+            if records is None:
+                failures.append((filename, error))
+                continue
+            normalise_codes(records)
+            if args.ocr_report:
+                ocr_records.extend(record for record in records if record.ocr_method)
+            yield from records
+
+    # Without the manifest, which would grow with every record, the next --incremental run rebuilds the workbook in full
+    writers = open_output_writers(args.output_format or ["xlsx"], args.lot_policy, args.cell_values, keep_manifest=False)
+    try:
+        for code, code_records in iter_code_groups(iter_loaded_records()):
+            # A table of a single code, whose ledger is computed once for every writer
+            write_code_ledgers(RecordTable.from_records(code_records), writers, args.lot_policy)
+    except BaseException:
+        for writer in writers:
+            writer.discard()
+        raise
+    finally:
+        progress_counter.finish()
+        if cache_filename:
+            get_extraction_cache(cache_filename).evict(args.cache_max_age, args.cache_max_entries)
+            close_extraction_cache(cache_filename)
+    for writer in writers:
+        writer.close()
+
+    for filename, error in failures:
+        print("Failed to process " + filename + ": " + error, file=sys.stderr)
+    if args.ocr_report:
+        print_ocr_report(ocr_records)
+
+def write_profile_report(args: argparse.Namespace) -> None:
+    report = PROFILER.report(args.profile_top)
+    text = json.dumps(report, indent=4) if args.profile == "json" else format_profile_report(report)
+    if args.profile_output:
+        with open(args.profile_output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+ 
+if __name__ == "__main__":
+    if(len(sys.argv) > 1 and sys.argv[1] == "help"):
+        display_help()
+        exit()
+    if len(sys.argv) > 1 and sys.argv[1] == "query":
+        query_investment_records(sys.argv[2:])
+        exit()
+    argument_parser = build_argument_parser()
+    args = argument_parser.parse_args()
+
+    configure_ocr(args.ocr_dpi, args.ocr_workers)
+    try:
+        configure_extraction_backends(parse_extraction_backends(args.extraction_backend))
+    except ValueError as e:
+        argument_parser.error(str(e))
+    if args.stream and (args.incremental or args.watch):
+        argument_parser.error("--stream can't be used with --incremental or --watch")
+    if args.window < 1:
+        argument_parser.error("--window must be at least 1")
+    enable_profiling(args.profile is not None)
+    if not args.no_cache and args.rebuild_cache:
+        cache = ExtractionCache(args.cache_file)
+        cache.clear()
+        cache.close()
+
+    if args.stream:
+        try:
+            stream_investment_records(args)
+        except CodeNotGroupedError as e:
+            sys.exit(str(e) + ". Run without --stream to read every file before writing.")
+        if args.profile:
+            write_profile_report(args)
+        sys.exit()
+
+    manifest = ScanManifest(args.scan_manifest, args.path, args.include, args.exclude)
+    if args.full_scan:
+        manifest.directories = {}
+    records_by_filename = {}
+    incremental = args.incremental
+    first_pass = True
+    while True:
+        with profile_stage("scan"):
+            filenames, changed, removed = manifest.scan(args.path)
+        # Records of changed or removed files are forgotten, so changed files are read again
+        for filename in removed + [filename for filename, record_type in changed]:
+            records_by_filename.pop(filename, None)
+        if first_pass or changed or removed:
+            # The workbook from before --watch started keeps its timestamped backup, later updates share one
+            tally_investment_records(args, filenames, records_by_filename, incremental, not first_pass)
+            if args.profile:
+                write_profile_report(args)
+                # Each update of --watch mode is reported on its own
+                enable_profiling()
+        manifest.save()
+        if not args.watch:
+            break
+        # Later passes only need to bring the workbook up to date
+        incremental = True
+        first_pass = False
+        time.sleep(args.watch_interval)